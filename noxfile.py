@@ -1,7 +1,11 @@
+import hashlib
 import os
 from pathlib import Path
+import re
+import subprocess
 import sys
 import nox
+from filelock import FileLock  # Dependency of virtualenv, so always available
 
 # from nox_poetry import session
 
@@ -18,33 +22,210 @@ os.environ["PY_IGNORE_IMPORTMISMATCH"] = "1"  # To avoid ImportMismatchError
 # By default, we only execute the conda tests because the others required various python
 # interpreters to be installed.  The other tests can be run, e.g., with `nox -s test` if
 # desired.
-nox.options.sessions = ["test"]
+nox.options.sessions = ["test", "test_version_specific"]
 
 DEV_PY = os.environ.get("DEV_PY", "3.10")
-python_versions = ["3.11", "3.10", "3.9", "3.8", "3.7", "3.6"]
+# The python matrix can be restricted with, e.g., PY="3.10 3.11" so that a CI job only
+# creates and populates venvs for the versions it needs.
+python_versions = os.environ.get("PY", "3.11 3.10 3.9 3.8 3.7 3.6").split()
 args = dict(python=python_versions, reuse_venv=True)
 
+# Set NOX_COVERAGE_FRESH=1 to remove stale coverage data files from previous runs so
+# that they do not get mixed into the new report.
+if os.environ.get("NOX_COVERAGE_FRESH") == "1":
+    for _p in Path().glob(".coverage.*"):
+        _p.unlink()
 
-@nox.session(**args)
-def test(session):
-    # args = [] if session.python.startswith("2") else ["--use-feature=in-tree-build"]
-    session.install(".[test]")
+# Distribute tests across all cores with pytest-xdist.  We use --dist=loadfile so that
+# all tests in a module run on the same worker: the DataSet tests create temporary
+# directories in the current working directory and should not interleave.
+xdist_args = ["-n", "auto", "--dist=loadfile"]
+
+# Always report the slowest tests so that the long tail is visible.  Tests that take more
+# than about a second should be marked `slow` so that `nox -s test_fast` skips them.
+durations_args = ["--durations=20"]
+
+
+PIP_CACHE_DIR = ".pip-cache"
+
+# Must match [build-system] requires in pyproject.toml.
+BUILD_REQUIRES = ["flit-core>=3.4"]
+
+
+def install_lock():
+    """Return a lock serializing installs across concurrent nox processes."""
+    Path(".nox").mkdir(exist_ok=True)
+    return FileLock(str(Path(".nox", "install.lock")))
+
+
+def install(session, *args, location=None):
+    """Install `args` into the session, skipping the dependency resolution if the
+    requirements have not changed since the venv was last populated.
+
+    The key is a hash of `pyproject.toml` and `args` which is stored in the venv.  On a
+    hit, we only reinstall the project itself (without dependencies) so that changes to
+    the source are still picked up.  CI caches `.nox/` with the same key.
+
+    Arguments
+    ---------
+    location : Path, optional
+       Location of an externally managed environment (e.g. conda) whose `python` is on
+       the session `PATH`.  If not provided, the session virtualenv is used (in which
+       case `python` is also the venv interpreter).
+
+    Set `NOX_NO_INSTALL=1` to skip all installs (e.g. in a prepared container, along
+    with `nox --no-venv`).
+    """
+    if os.environ.get("NOX_NO_INSTALL"):
+        return
+
+    if location is None:
+        location = getattr(session.virtualenv, "location", None)
+
+    # Use a persistent wheel cache (cached on CI) and prefer binary wheels.
+    session.env["PIP_CACHE_DIR"] = str(Path(PIP_CACHE_DIR).resolve())
+
+    def pip_install(*args):
+        # run_always is skipped by `nox -R` (or --no-install) so that iterating on a
+        # warm venv does not invoke pip at all.  Returns None if skipped.
+        return session.run_always(
+            "python", "-m", "pip", "install", "-q", *args, external=True
+        )
+
+    # Serialize installs so that sessions can be run concurrently (e.g.
+    # `nox -s test-3.10 & nox -s test-3.11 & wait`) without racing on the shared pip
+    # cache.  The tests themselves still run in parallel.
+    with install_lock():
+        key = hashlib.sha256(
+            Path("pyproject.toml").read_bytes() + " ".join(args).encode()
+        ).hexdigest()
+        marker = Path(location, ".reqhash") if location else None
+        if marker and marker.exists() and marker.read_text() == key:
+            session.log("Requirements unchanged: cache hit.")
+            pip_install("--no-deps", "--force-reinstall", "--no-build-isolation", ".")
+            return
+
+        # Install the build backend once so that the project can be built without
+        # creating an isolated build environment each time.
+        pip_install("--upgrade", "pip", *BUILD_REQUIRES)
+        if (
+            pip_install("--prefer-binary", "--no-build-isolation", *args) is not None
+            and marker
+        ):
+            marker.write_text(key)
+
+
+def run_coverage(session, *args, notify=True, **kw):
+    """Run pytest with coverage, writing a distinct data file per session.
+
+    If `notify` is `True`, then the coverage session is run afterwards to combine the
+    data and produce the report.  This should only be done by runs that measure the
+    full suite: the report checks `fail_under`.
+    """
+    # Coverage is measured with pytest-cov rather than `coverage run`: the xdist workers
+    # are separate processes that `coverage run` does not trace, while pytest-cov starts
+    # coverage in each worker and combines their data in the controller, which writes a
+    # single data file.  The coverage session then combines the files of all sessions.
+    session.env["COVERAGE_FILE"] = ".coverage.{}".format(
+        re.sub(r"[^\w.-]", "_", session.name)
+    )
+    # Each run only covers part of the code (one shard, or one set of markers), so
+    # fail_under is only checked on the combined report by the coverage session.
+    cov_args = ["--cov=persist", "--cov-report=", "--cov-fail-under=0"]
     try:
-        session.run("coverage", "run", "-m", "pytest", *session.posargs)
+        session.run("pytest", *cov_args, *args, **kw)
     finally:
-        if session.interactive:
+        if notify:
             session.notify("coverage", posargs=[])
 
 
+@nox.session(**args)
+@nox.parametrize("shard", [nox.param(1, id="a"), nox.param(2, id="b")])
+def test(session, shard):
+    """Run the test suite.
+
+    The suite is split (with pytest-split) into two shards `a` and `b` so that CI can
+    run them as separate jobs, e.g. `nox -s "test-3.11(a)"`.  A plain `nox` runs both.
+
+    Tracing roughly triples the run time, so coverage is only measured on `DEV_PY`
+    (for the full suite, in both shards).  Tests of version dependent code should be
+    marked `version_specific` so that they are measured on all versions by
+    :func:`test_version_specific`, whose data is added to the report of this session.
+    """
+    install(session, ".[test]")
+    pytest_args = ["--splits", "2", "--group", str(shard)]
+    if session.python == "3.6":
+        # pytest-split needs python >= 3.7: run everything in the first shard.
+        if shard != 1:
+            session.skip("pytest-split is not available.")
+        pytest_args = []
+    pytest_args.extend(xdist_args + durations_args)
+    if session.python == DEV_PY:
+        run_coverage(session, *pytest_args, *session.posargs)
+    else:
+        session.run("pytest", *pytest_args, *session.posargs)
+
+
+@nox.session(**args)
+def test_version_specific(session):
+    """Run only the `version_specific` tests, measuring coverage on all versions.
+
+    This does not produce a report by itself (it only covers these tests): the data is
+    combined by the coverage session run after :func:`test`.
+    """
+    install(session, ".[test]")
+    # Exit code 5 means no tests were collected (e.g. all are skipped).
+    run_coverage(
+        session,
+        "-m",
+        "version_specific",
+        *session.posargs,
+        notify=False,
+        success_codes=[0, 5],
+    )
+
+
+@nox.session(**args)
+def test_fast(session):
+    """Run the test suite without the tests marked `slow` (for quick iteration)."""
+    install(session, ".[test]")
+    # This -m replaces the one in addopts, so we must also exclude the benchmarks.
+    session.run("pytest", "-m", "not slow and not bench", *xdist_args, *session.posargs)
+
+
+@nox.session(python=DEV_PY, reuse_venv=True)
+def inline(session):
+    """Run only the pytest-inline tests (`itest()` statements next to the code).
+
+    Use `nox -s inline -- --inlinetest-group=<tag>` to run a tagged subset.
+    """
+    # pytest-inline is not compatible with pytest 8 (and breaks normal collection), so
+    # it is not part of the test extra and we pin pytest here.
+    install(session, ".[test]", "pytest-inline>=1.0.0", "pytest<8")
+    session.run(
+        "pytest",
+        "--inlinetest-only",
+        "--inlinetest-ignore-import-errors",
+        "-n",
+        "auto",
+        *session.posargs,
+        # Exit code 5 means no tests were collected.
+        success_codes=[0, 5],
+    )
+
+
 # https://github.com/cjolowicz/cookiecutter-hypermodern-python/blob/main/%7B%7Bcookiecutter.project_name%7D%7D/noxfile.py
-@nox.session(python=DEV_PY)
+@nox.session(python=DEV_PY, reuse_venv=True)
 def coverage(session):
     """Produce the coverage report."""
     args = session.posargs or ["report"]
     session.install("coverage[toml]>=7.2.2")
     session.install("genbadge[coverage]")
-    if not session.posargs and any(Path().glob(".coverage.*")):
-        session.run("coverage", "combine", "--debug=pathmap")
+    # Always combine any data files from the test sessions (python versions and shards)
+    # before generating the reports.  We --keep the data files so that CI can
+    # still upload them for the combined report across the matrix.
+    if any(Path().glob(".coverage.*")):
+        session.run("coverage", "combine", "--keep", "--debug=pathmap")
 
     session.run("coverage", "xml", "-o", "build/_coverage/coverage.xml")
     session.run(
@@ -58,8 +239,61 @@ def coverage(session):
     session.run("coverage", *args)
 
 
-@nox.session(venv_backend="conda", **args)
-def test_conda(session):
-    # args = [] if session.python.startswith("2") else ["--use-feature=in-tree-build"]
-    session.install(".[test]")
-    session.run("pytest")
+CONDA_EXE = os.environ.get("CONDA_EXE", "conda")
+
+
+def _conda_python_version(prefix):
+    """Return the `major.minor` python version in the conda env at `prefix`."""
+    python = Path(prefix, "bin", "python")
+    if not python.exists():
+        return None
+    return subprocess.run(
+        [str(python), "-c", "import sys; print('%i.%i' % sys.version_info[:2])"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+def _conda_create(session, prefix, *args):
+    session.run(
+        CONDA_EXE, "create", "-y", "-q", "-p", str(prefix), *args, external=True
+    )
+
+
+def conda_env(session, python):
+    """Return the prefix of a conda env for `python`, cloning it from a template.
+
+    Creating a conda environment from scratch invokes the solver (~10s per version).
+    Instead, we create a template environment `.nox/_conda_template-<python>` with only
+    `python` and `pip` once, and then clone it with `conda create --clone` which is much
+    faster.  If the template does not have the requested version, we fall back to a
+    plain `conda create`.
+    """
+    prefix = Path(".nox", "test_conda-{}".format(python)).resolve()
+    if _conda_python_version(prefix) == python:
+        return prefix  # Reuse existing environment
+
+    with install_lock():
+        template = Path(".nox", "_conda_template-{}".format(python)).resolve()
+        spec = ["python={}".format(python), "pip"]
+        if not template.exists():
+            _conda_create(session, template, *spec)
+
+        if _conda_python_version(template) == python:
+            _conda_create(session, prefix, "--clone", str(template))
+        else:
+            _conda_create(session, prefix, *spec)
+    return prefix
+
+
+@nox.session(venv_backend="none")
+@nox.parametrize("py", python_versions)
+def test_conda(session, py):
+    prefix = conda_env(session, py)
+    session.env["CONDA_PREFIX"] = str(prefix)
+    session.env["PATH"] = os.pathsep.join(
+        [str(prefix / "bin"), os.environ.get("PATH", "")]
+    )
+    install(session, ".[test]", location=prefix)
+    session.run("pytest", *xdist_args, *durations_args, *session.posargs, external=True)
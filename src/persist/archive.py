@@ -93,9 +93,10 @@ Limitations
 
 - Only some sparse matrices are supported:
 
+     >>> import scipy.sparse
      >>> M = np.random.random((10, 10))
      >>> a = Archive()
-     >>> a.insert(lil=sp.sparse.lil_matrix(M))
+     >>> a.insert(lil=scipy.sparse.lil_matrix(M))
      >>> a
      Traceback (most recent call last):
      NotImplementedError: lil_matrix
@@ -120,7 +121,8 @@ Developer's Note
    - Make sure that numpy arrays from tostring() are *NOT* subject to
      replacement somehow.  Not exactly sure how to reproduce the
      problem, but it is quite common for these to have things like
-     '_x' in the string.
+     '_x' in the string.  (These are now base64 encoded, which cannot
+     contain '_', so the temporary names cannot appear.)
    - Graph reduction occurs for nodes that have more than one parent.
      This does not consider the possibility that a single node may
      refer to the same object several times.  This has to be examined
@@ -206,50 +208,38 @@ unreliable::
    except NameError: pass
 
 """
-from __future__ import division, with_statement
-
-from collections import OrderedDict
+from collections import ChainMap, OrderedDict, deque
 from contextlib import contextmanager
 
-try:  # Python 3 version
-    import builtins
-    import pickle
-except ImportError:  # pragma: no cover
-    # Python 2 version
-    import cPickle as pickle
-    import __builtin__ as builtins
 import ast
-import copy
+import base64
+import builtins
+import cmath
+import concurrent.futures
+import functools
+import glob
+import importlib.util
 import inspect
 import logging
+import marshal
 import os
+import pickle
 import re
+import shutil
 import string
 import sys
+import threading
 import time
 import types
 import warnings
 
-import six
-
-from ._contrib.RADLogic import topsort
-
 try:
     import numpy as np
 except ImportError:  # pragma: no cover
     np = None
 
-try:
-    import scipy.sparse
-
-    sp = scipy
-except ImportError:  # pragma: no cover
-    sp = None
-
-try:
-    import h5py
-except ImportError:  # pragma: no cover
-    h5py = None
+# scipy.sparse and h5py are slow to import, so are only imported when needed.
+# (See Archive._get_handler() and ArrayManager.save_arrays().)
 
 from . import interfaces
 from . import objects
@@ -267,11 +257,58 @@ __all__ = [
 
 _HDF5_EXTS = set(["hf5", "hd5", "hdf5"])
 
+# Characters that may not precede a name replaced by _replace_rep(): either the
+# match is part of a longer identifier, or it is an attribute.
+_NOT_BEFORE_NAME = frozenset(string.ascii_letters + string.digits + "_.")
+
+# Attributes passed to the constructor of supported sparse matrices.  This is
+# populated by _register_sparse() once scipy.sparse has been imported.
+_SPMATRIX_ARGS = {}
+
+# Exact types dispatched directly by Archive.get_persistent_rep().
+_BUILTIN_TYPES = frozenset([list, tuple, dict, float, complex])
+
+# Exact types whose repr is a literal with no names to import.
+_LITERAL_TYPES = frozenset([int, str, bytes, bool, type(None)])
+
+# Exact types that is_simple() accepts without looking at the value.
+_SIMPLE_TYPES = frozenset([bool, int, str, type(None)])
+
+# `active` is set in the threads computing representations concurrently (see
+# GraphMixin._get_persistent_reps()).
+_CONCURRENT = threading.local()
+
+# Definition of a node with arguments or imports in Archive.scoped__str__().
+_SCOPED_DEF_TEMPLATE = "\n".join(
+    [
+        "",
+        "def %(name)s(%(args)s):%(imports)s",
+        "    return %(rep)s",
+        "%(name)s = %(name)s()",
+    ]
+)
+
+# Names that may appear in the repr of numpy arrays.
+_NUMPY_INF_NAN_IMPORTS = (
+    ("numpy", "inf", "inf"),
+    ("numpy", "inf", "Infinity"),
+    ("numpy", "inf", "Inf"),
+    ("numpy", "inf", "infty"),
+    ("numpy", "nan", "nan"),
+    ("numpy", "nan", "NaN"),
+    ("numpy", "nan", "NAN"),
+)
+
 
 class ArchiveError(Exception):
     r"""Archiving error."""
 
 
+class _Deferred(Exception):
+    r"""Raised by a handler in a worker thread if it must instead be called in
+    graph order (see GraphMixin._get_persistent_reps())."""
+
+
 class CycleError(ArchiveError):
     r"""Cycle found in archive."""
     message = "Archive contains cyclic dependencies."
@@ -310,8 +347,8 @@ def unique_list(xs, preserve_order=True):
     """
     try:
         if preserve_order:
-            s = set()
-            return [x for x in xs if x not in s and not s.add(x)]
+            # dicts preserve insertion order
+            return list(dict.fromkeys(xs))
         else:
             return list(set(xs))
     except TypeError:  # Special case for non-hashable types
@@ -322,7 +359,7 @@ def unique_list(xs, preserve_order=True):
         return res
 
 
-def restore(archive, env={}):
+def restore(archive, env=None):
     r"""Return dictionary obtained by evaluating the string arch.
 
     arch is typically returned by converting an Archive instance into
@@ -338,11 +375,57 @@ def restore(archive, env={}):
     1, 2
     """
     ld = {}
-    ld.update(env)
+    if env:
+        ld.update(env)
+    if isinstance(archive, str) and len(archive) <= _COMPILE_CACHE_MAX_LEN:
+        archive = _compile_archive(archive)
     exec(archive, ld)
     return ld
 
 
+# Only archives up to this length are cached by _compile_archive(): the cache
+# keeps both the string and its code (with any inline array data) alive.
+_COMPILE_CACHE_MAX_LEN = 2**16
+
+
+@functools.lru_cache(maxsize=32)
+def _compile_archive(archive):
+    r"""Return the compiled code for the string `archive`.
+
+    The code is cached for small archives that are restored repeatedly, where
+    compilation dominates :func:`restore`.
+    """
+    return compile(archive, "<string>", "exec", dont_inherit=True)
+
+
+def _get_backup_name(filename):
+    """Return an unused backup name for `filename`.
+
+    Existing backups are listed with a single directory scan and the next
+    number is one past the largest in use.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> filename = os.path.join(d, 'a.txt')
+    >>> os.path.basename(_get_backup_name(filename))
+    'a.txt.bak'
+    >>> for name in ['a.txt.bak', 'a.txt_2.bak', 'a.txt_x.bak']:
+    ...     open(os.path.join(d, name), 'w').close()
+    >>> os.path.basename(_get_backup_name(filename))
+    'a.txt_3.bak'
+    >>> shutil.rmtree(d)
+    """
+    existing = glob.glob(glob.escape(filename) + "*.bak")
+    backup_name = filename + ".bak"
+    if backup_name not in existing:
+        return backup_name
+    number_re = re.compile(re.escape(filename) + r"_(\d+)\.bak$")
+    n = 1 + max(
+        (int(_m.group(1)) for _m in map(number_re.match, existing) if _m), default=0
+    )
+    return filename + "_%i.bak" % (n)
+
+
 @contextmanager
 def backup(filename, keep=True):
     """Context to temporarily backup `filename`.
@@ -354,11 +437,7 @@ def backup(filename, keep=True):
     """
     backup_name = None
     if os.path.exists(filename):
-        backup_name = filename + ".bak"
-        n = 1
-        while os.path.exists(backup_name):
-            backup_name = filename + "_%i.bak" % (n)
-            n += 1
+        backup_name = _get_backup_name(filename)
         os.rename(filename, backup_name)
 
     yield backup_name
@@ -368,6 +447,34 @@ def backup(filename, keep=True):
         os.remove(backup_name)
 
 
+@contextmanager
+def replace_file(filename, keep=False):
+    """Context to atomically replace `filename`.
+
+    Yields a temporary name in the same directory to write the new contents to.
+    If the context completes without an exception, the temporary file replaces
+    `filename` with :func:`os.replace`, so readers never see a missing or
+    partially written file.  If `keep` is `True` and `filename` exists, it is
+    first linked (or copied) to a backup named as in :func:`backup`.
+    """
+    tmp_name = "%s.%i.%i.tmp" % (filename, os.getpid(), threading.get_ident())
+    try:
+        yield tmp_name
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+    if keep and os.path.exists(filename):
+        backup_name = _get_backup_name(filename)
+        try:
+            os.link(filename, backup_name)
+        except OSError:  # pragma: no cover
+            # Hard links are not supported on all file systems.
+            shutil.copy2(filename, backup_name)
+    os.replace(tmp_name, filename)
+
+
 class ArrayManager(object):
     """Class for managing arrays on disk.
 
@@ -375,6 +482,18 @@ class ArrayManager(object):
     formats.
     """
 
+    # Options passed to :meth:`h5py.Group.create_dataset`.  LZF ships with h5py
+    # (no plugins needed) and is fast enough not to dominate write times.
+    hdf5_compression = dict(compression="lzf", shuffle=True)
+
+    # Target size of HDF5 chunks (see :meth:`get_hdf5_chunks`).
+    hdf5_chunk_nbytes = 2**20
+
+    # Arrays with fewer bytes than this are stored contiguously without
+    # compression: for many small arrays the chunk index and filter pipeline
+    # cost more than compression saves.
+    hdf5_compression_nbytes = 2**16
+
     hdf5_code = """
     def {DATA_NAME}():
         import os.path, numpy, h5py
@@ -411,7 +530,7 @@ class ArrayManager(object):
         res = {{}}
         for name in {NAMES}:
             filename = os.path.join(dir, {FILENAME:s}, name + ".npy")
-            res[name] = numpy.asarray(numpy.load(filename))
+            res[name] = numpy.asarray(numpy.load(filename{LOAD_ARGS}))
         return res
 
     {DATA_NAME} = {DATA_NAME}()
@@ -426,6 +545,30 @@ class ArrayManager(object):
             ext = basename.split(os.path.extsep)[-1].lower()
         return ext
 
+    @classmethod
+    def get_hdf5_chunks(cls, array):
+        """Return the HDF5 chunk shape for `array`.
+
+        Arrays are always read whole, so chunks are full slabs along the first
+        axis of at most :attr:`hdf5_chunk_nbytes`: a read then decompresses a few
+        large contiguous chunks.  If a single slab is larger than this, we let
+        h5py choose (`True`).
+
+        >>> import numpy as np
+        >>> ArrayManager.get_hdf5_chunks(np.zeros((1000, 10)))
+        (1000, 10)
+        >>> ArrayManager.get_hdf5_chunks(np.zeros((10**6, 10)))
+        (13107, 10)
+        >>> ArrayManager.get_hdf5_chunks(np.zeros((2, 10**6)))
+        True
+        """
+        shape = array.shape
+        slab_nbytes = array.itemsize * int(np.prod(shape[1:]))
+        if not shape or slab_nbytes == 0 or cls.hdf5_chunk_nbytes < slab_nbytes:
+            return True
+        rows = min(shape[0], cls.hdf5_chunk_nbytes // slab_nbytes)
+        return (rows,) + shape[1:]
+
     @classmethod
     def save_arrays(
         cls,
@@ -435,6 +578,7 @@ class ArrayManager(object):
         keep=False,
         data_format="npy",
         arrays_name="_arrays",
+        mmap_mode=None,
     ):
         """Return `(rep, files)` and save the array.
 
@@ -453,6 +597,13 @@ class ArrayManager(object):
         arrays_name : str
            Name of dictionary in which to store the `arrays` dict in the executable
            string.
+        mmap_mode : None, 'r', 'c'
+           If provided, then `npy` arrays are loaded with :func:`numpy.load` using
+           this `mmap_mode`.  The data is then mapped from disk rather than read
+           and copied, and pages are only read when accessed.  With `'r'` the
+           arrays are read-only.  With `'c'` (copy-on-write) they can be modified
+           in memory without changing the file.  (Ignored for other formats,
+           which cannot be memory mapped.)
 
         Returns
         -------
@@ -471,9 +622,11 @@ class ArrayManager(object):
                 os.makedirs(dirname)
             for name in arrays:
                 _filename = os.path.join(dirname, os.path.extsep.join([name, "npy"]))
-                with backup(_filename, keep=keep):
-                    np.save(_filename, arrays[name])
-                    files.append(_filename)
+                with replace_file(_filename, keep=keep) as tmp_name:
+                    # Pass a file so np.save does not append an extension.
+                    with open(tmp_name, "wb") as f:
+                        np.save(f, arrays[name])
+                files.append(_filename)
             res = cls.npy_code
         elif data_format in ["hdf5", "npz"]:
             if filename is None:
@@ -486,16 +639,35 @@ class ArrayManager(object):
             elif data_format == "npz" and ext != "npz":
                 filename = os.path.extsep.join([filename, "npz"])
             _filename = os.path.join(dirname, filename)
-            with backup(_filename, keep=keep):
+            with replace_file(_filename, keep=keep) as tmp_name:
                 if data_format == "hdf5":
+                    import h5py
+
                     res = cls.hdf5_code
-                    with h5py.File(_filename, "w") as f:
+                    with h5py.File(tmp_name, "w") as f:
                         for name in arrays:
-                            f[name] = arrays[name]
+                            array = np.asarray(arrays[name])
+                            # Timestamps are not needed (the file is replaced as a
+                            # whole) and would make identical data differ.
+                            if array.size > 1 and (
+                                cls.hdf5_compression_nbytes <= array.nbytes
+                            ):
+                                f.create_dataset(
+                                    name,
+                                    data=array,
+                                    chunks=cls.get_hdf5_chunks(array),
+                                    track_times=False,
+                                    **cls.hdf5_compression,
+                                )
+                            else:
+                                # Small arrays, and scalars and empty arrays (which
+                                # cannot be chunked), are stored contiguously.
+                                f.create_dataset(name, data=array, track_times=False)
                 else:  # data_format == 'npz'
                     res = cls.npz_code
-                    np.savez(_filename, **arrays)
-                files.append(_filename)
+                    with open(tmp_name, "wb") as f:
+                        np.savez(f, **arrays)
+            files.append(_filename)
         else:
             raise NotImplementedError(
                 "Expected data_format in ['hdf5', 'npz', 'npy'], got {}".format(
@@ -511,6 +683,7 @@ class ArrayManager(object):
             NAMES="[{}]".format(", ".join(map(repr, arrays))),
             DIRNAME=repr(dirname),
             FILENAME=repr(filename),
+            LOAD_ARGS="" if mmap_mode is None else ", mmap_mode=%r" % (mmap_mode,),
         )
         return rep, files
 
@@ -550,9 +723,9 @@ class Archive(object):
        If `True`, then use a depth-first algorithm to reduce the dependency
        graph, otherwise use a tree.  (See :meth:`make_persistent`.)
     tostring : True, False, optional
-       If `True`, then use :meth:`numpy.ndarray.tostring` to
-       format numpy strings.  This is more robust, but not
-       human-readable and may be larger.
+       If `True`, then store the raw bytes of numpy arrays (from
+       :meth:`numpy.ndarray.tobytes`) base64 encoded.  This is more robust and
+       faster, but not human-readable.
     check_in_insert : False, True, optional
        If `True`, then try to make string representation of each
        object on insertion to allow for early catching of errors.
@@ -567,6 +740,10 @@ class Archive(object):
        archived.  Instead, they will be stored in :attr:`data` and
        will need to be stored externally.  (If this is `inf`, then all
        data will be stored the string representation of the archive.)
+    inline_nbytes : int, optional
+       Numpy arrays using at most this many bytes are stored in the string
+       representation even if they exceed :attr:`array_threshold`.  Writing and
+       opening a separate data file costs more than encoding a small array.
     data_name : str
        This is the name of the dictionary-like object containing
        external objects.  This need not be provided, but it will not
@@ -599,6 +776,12 @@ class Archive(object):
        If `True`, then :func:`_replace_rep_robust` instead of
        :func:`_replace_rep`.  This is much more robust, but can be much slower
        as it invokes the python parser.
+    max_workers : int, optional
+       If provided, then the representations of sibling objects in the
+       dependency graph are computed concurrently by a thread pool with this
+       many workers.  This helps when archiving many large arrays, whose
+       serialization is mostly done in C, but brings nothing for pure python
+       objects.
 
     Notes
     -----
@@ -705,6 +888,8 @@ class Archive(object):
         gname_prefix="_g",
         scoped=True,
         robust_replace=True,
+        max_workers=None,
+        inline_nbytes=0,
     ):
         self.tostring = tostring
         self.flat = flat
@@ -733,16 +918,31 @@ class Archive(object):
                 array_threshold = np.inf
 
         self.array_threshold = array_threshold
+        self.inline_nbytes = inline_nbytes
 
         self.check_on_insert = check_on_insert
         self.data = {}
 
         self.scoped = scoped
         self.robust_replace = robust_replace
+        self.max_workers = max_workers
+
+        # Guards state shared by get_persistent_rep() when using threads.
+        self._lock = threading.RLock()
+
+        # True while the numpy print options are set (see _executor()).
+        self._printoptions_set = False
 
         self._maxint = -1  # Cache of maximum int label in archive
         self._ids = OrderedDict()
 
+        # Indices into self.arch for fast lookup in insert().  _id_index maps the
+        # get_id() of each object to its first entry.
+        self._name_index = {}
+        self._id_index = {}
+
+        self._dispatch_cache = {}  # See _get_handler()
+
     def get_id(self, obj):
         """Return a unique id for the object.
 
@@ -765,14 +965,22 @@ class Archive(object):
         has either `import module as uiname`, `from module import
         iname` or `from module import iname as uiname`.
         """
+        cls = type(obj)
+        if cls in _BUILTIN_TYPES:
+            # Fast path: instances of these cannot provide interfaces directly.
+            return self._dispatch[cls](self, obj, env=env)
+        if cls in _LITERAL_TYPES:
+            # Would otherwise fall through to get_persistent_rep_repr().
+            return (repr(obj), {}, [])
+
         if interfaces.IArchivable.providedBy(obj) or isinstance(
             obj, objects.Archivable
         ):
             return obj.get_persistent_rep(env)
 
-        for class_ in self._dispatch:
-            if isinstance(obj, class_):
-                return self._dispatch[class_](self, obj, env=env)
+        handler = self._get_handler(cls)
+        if handler:
+            return handler(self, obj, env=env)
 
         if inspect.ismethod(obj):
             return get_persistent_rep_method(obj, env)
@@ -812,49 +1020,85 @@ class Archive(object):
         else:
             return get_persistent_rep_repr(obj, env, rep=rep)
 
+    def _get_handler(self, cls):
+        """Return the `_dispatch` handler for instances of `cls` or `None`.
+
+        The results of the :func:`isinstance` search are cached by type.
+        """
+        try:
+            return self._dispatch_cache[cls]
+        except KeyError:
+            pass
+        sparse = sys.modules.get("scipy.sparse", None)
+        if sparse is not None and sparse.spmatrix not in self._dispatch:
+            self._register_sparse(sparse)
+
+        handler = None
+        for class_ in self._dispatch:
+            if issubclass(cls, class_):
+                handler = self._dispatch[class_]
+                break
+        self._dispatch_cache[cls] = handler
+        return handler
+
     def _archive_ndarray(self, obj, env):
         """Archival of numpy arrays."""
-        if self.array_threshold < np.prod(obj.shape):
+        # obj.size is stored on the array: np.prod(obj.shape) would build a
+        # temporary array.
+        if self.array_threshold < obj.size and self.inline_nbytes < obj.nbytes:
             # Data should be archived to a data file.
-            array_name = None
-            for array_name in self.data:
-                # Check if array exists first
-                if self.data[array_name] is obj:
-                    break
-                else:
-                    array_name = None
-
-            if array_name is None:
-                array_prefix = "array_"
-                i = self._maxint + 1
-                array_name = array_prefix + str(i)
-                while array_name in self.data:
-                    # This should only execute a few times if the user, for
-                    # example, included manually an element with name
-                    # "array_<n>" for example.
-                    i += 1
+            if getattr(_CONCURRENT, "active", False):
+                # Array names are allocated in graph order so that they do not
+                # depend on the timing of the threads.
+                raise _Deferred()
+            with self._lock:
+                data = self.data
+                array_name = None
+                for array_name in data:
+                    # Check if array exists first
+                    if data[array_name] is obj:
+                        break
+                    else:
+                        array_name = None
+
+                if array_name is None:
+                    array_prefix = "array_"
+                    i = self._maxint + 1
                     array_name = array_prefix + str(i)
-                    self._maxint = i
-                self.data[array_name] = obj
+                    while array_name in data:
+                        # This should only execute a few times if the user, for
+                        # example, included manually an element with name
+                        # "array_<n>" for example.
+                        i += 1
+                        array_name = array_prefix + str(i)
+                        self._maxint = i
+                    data[array_name] = obj
 
             rep = "%s['%s']" % (self.data_name, array_name)
             args = {}
             imports = []
         elif self.tostring and obj.__class__ is np.ndarray and not obj.dtype.hasobject:
-            rep = "numpy.frombuffer(%r, dtype=%r).reshape(%s)" % (
-                obj.tostring(),
+            # Base64 encoding is done in C and is much faster than the repr of the
+            # raw bytes.  It is also ASCII-safe and more compact.  The encoder
+            # reads the array buffer directly, so contiguous arrays are not copied
+            # (ascontiguousarray only copies if needed, like tobytes() would).
+            rep = "numpy.frombuffer(base64.b64decode(%r), dtype=%r).reshape(%s)" % (
+                base64.b64encode(np.ascontiguousarray(obj)).decode("ascii"),
                 obj.dtype.str,
                 str(obj.shape),
             )
-            imports = [("numpy", None, "numpy")]
+            imports = [("numpy", None, "numpy"), ("base64", None, "base64")]
             args = {}
         else:
-            popts = np.get_printoptions()
-            np.set_printoptions(**(self._numpy_printoptions))
-            rep = repr(obj)
-            np.set_printoptions(**popts)
+            if self._printoptions_set:
+                rep = repr(obj)
+            else:
+                # The print options may be global so must not be changed by
+                # other threads while we are using them.
+                with self._lock, np.printoptions(**self._numpy_printoptions):
+                    rep = repr(obj)
 
-            module = inspect.getmodule(obj.__class__)
+            module = get_module(obj.__class__)
 
             # Import A.B.C as C
             iname = module.__name__
@@ -864,28 +1108,16 @@ class Archive(object):
             if not constructor.startswith(mname):
                 rep = ".".join([mname, rep])
 
-            imports = [
-                (iname, None, mname),
-                ("numpy", "inf", "inf"),
-                ("numpy", "inf", "Infinity"),
-                ("numpy", "inf", "Inf"),
-                ("numpy", "inf", "infty"),
-                ("numpy", "nan", "nan"),
-                ("numpy", "nan", "NaN"),
-                ("numpy", "nan", "NAN"),
-            ]
+            imports = [(iname, None, mname)]
+            imports.extend(_NUMPY_INF_NAN_IMPORTS)
             args = {}
         return (rep, args, imports)
 
     def _archive_spmatrix(self, obj, env):
-        if (
-            sp.sparse.isspmatrix_csc(obj)
-            or sp.sparse.isspmatrix_csr(obj)
-            or sp.sparse.isspmatrix_bsr(obj)
-        ):
-            args = (obj.data, obj.indices, obj.indptr)
-        elif sp.sparse.isspmatrix_dia(obj):
-            args = (obj.data, obj.offsets)
+        for class_ in obj.__class__.__mro__:
+            if class_ in _SPMATRIX_ARGS:
+                args = tuple(getattr(obj, _attr) for _attr in _SPMATRIX_ARGS[class_])
+                break
         else:
             raise NotImplementedError(obj.__class__.__name__)
 
@@ -927,20 +1159,29 @@ class Archive(object):
         type: _archive_type,
     }
 
-    if hasattr(types, "ClassType"):  # pragma: no cover
-        # Old-style classes in python 2.
-        _dispatch[types.ClassType] = _archive_type
-
     if np:
         _dispatch.update({np.ndarray: _archive_ndarray, np.ufunc: _archive_func})
 
-    if sp:
-        _dispatch.update({sp.sparse.base.spmatrix: _archive_spmatrix})
+    @classmethod
+    def _register_sparse(cls, sparse):
+        r"""Add the dispatch for sparse matrices from the `scipy.sparse` module.
+
+        This is done lazily: any sparse matrix implies that the user already
+        imported :mod:`scipy.sparse`, so we need not import it ourselves.
+        """
+        _SPMATRIX_ARGS.update(
+            {
+                sparse.csc_matrix: ("data", "indices", "indptr"),
+                sparse.csr_matrix: ("data", "indices", "indptr"),
+                sparse.bsr_matrix: ("data", "indices", "indptr"),
+                sparse.dia_matrix: ("data", "offsets"),
+            }
+        )
+        cls._dispatch[sparse.spmatrix] = cls._archive_spmatrix
 
     def unique_name(self, name):
         r"""Return a unique name not contained in the archive."""
-        names = _unzip(self.arch)[0]
-        return UniqueNames(names).unique(name)
+        return UniqueNames(self._name_index).unique(name)
 
     def insert(self, v=None, env=None, **kwargs):
         r"""Insert named object pairs (kwargs) into the archive.
@@ -982,23 +1223,27 @@ class Archive(object):
         >>> a.insert(A=np.array([1, 2, 3]))
         >>> print(a)                     # doctest: +SKIP
         import numpy as _numpy
+        import base64 as _base64
         x = 2
         x_0 = 3
-        A = _numpy.frombuffer('\x01\x00\x00\x00\x00\x00\x00\x00\x02\x00\x00\x00\x00\x00\x00\x00\x03\x00\x00\x00\x00\x00\x00\x00', dtype='<i8').reshape((3,))
+        A = _numpy.frombuffer(_base64.b64decode('AQAAAAAAAAACAAAAAAAAAAMAAAAAAAAA'), dtype='<i8').reshape((3,))
         b = 5
         a = 4
         del _numpy
+        del _base64
         try: del __builtins__, _arrays
         except NameError: pass
 
         For testing purposes we have to sort the lines of the output:
 
         >>> print("\n".join(sorted(str(a).splitlines())))
-        A = _numpy.frombuffer(b'\x01\x00\x00\x00\x00\x00\x00\x00\x02\x00\x00\x00\x00\x00\x00\x00\x03\x00\x00\x00\x00\x00\x00\x00', dtype='<i8').reshape((3,))
+        A = _numpy.frombuffer(_base64.b64decode('AQAAAAAAAAACAAAAAAAAAAMAAAAAAAAA'), dtype='<i8').reshape((3,))
         a = 4
         b = 5
+        del _base64
         del _numpy
         except NameError: pass
+        import base64 as _base64
         import numpy as _numpy
         try: del __builtins__, _arrays
         x = 2
@@ -1061,10 +1306,10 @@ class Archive(object):
                     )
                 )
             name = list(kwargs)[0]
-            if self.arch and name not in self.names():
+            if self.arch and name not in self._name_index:
                 raise ValueError(
                     "Can't insert {} into single_item_mode=True archive with {}.".format(
-                        repr(name), repr(self.names()[0])
+                        repr(name), repr(self.arch[0][0])
                     )
                 )
 
@@ -1074,17 +1319,9 @@ class Archive(object):
                 raise ValueError("name must not start with '_'")
 
             # First check to see if object is already in archive:
-            unames, objs, envs = _unzip(self.arch)
-
-            obj_ids = list(map(self.get_id, objs))
             obj_id = self.get_id(obj)
-            obj_ind = None
-            if obj_id in obj_ids:
-                obj_ind = obj_ids.index(obj_id)
-
-            name_ind = None
-            if name in unames:
-                name_ind = unames.index(name)
+            obj_ind = self._id_index.get(obj_id, None)
+            name_ind = self._name_index.get(name, None)
 
             ind = None
             if name_ind is not None:
@@ -1106,11 +1343,13 @@ class Archive(object):
 
                 self.arch.append((uname, obj, env))
                 ind = len(self.arch) - 1
+                self._name_index[uname] = ind
+                self._id_index.setdefault(obj_id, ind)
 
             assert ind is not None
-            uname, obj, env = self.arch[ind]
+            uname = self.arch[ind][0]
             names.append(uname)
-            self.ids[uname] = self.get_id(obj)
+            self.ids[uname] = obj_id
 
     def make_persistent(self):
         r"""Return `(imports, defs)` representing the persistent
@@ -1180,7 +1419,8 @@ class Archive(object):
         graphs (DAG), but the algorithm must determine if there is
         a cycle and raise an exception in this case.
 
-        We use the :mod:`topsort` library to do this.
+        We use Kahn's algorithm to do this (see
+        :meth:`GraphMixin._topological_order`).
 
         We would also like to (optionally) perform reductions of
         the graph in the sense that we remove a node from the
@@ -1226,22 +1466,19 @@ class Archive(object):
         # First we build the dependency tree using the nodes and a
         # depth first search.  The nodes dictionary maps each id to
         # the tuples (obj, (rep, args, imports), parents) where the
-        # children are specified by the "args" and parents is a set of
+        # children are specified by the "args" and parents is a list of
         # the parent ids.  The nodes dictionary also acts as the
         # "visited" list to prevent cycles.
 
-        # #names = _unzip(self.arch)[0]
-
         # Generate dependency graph
-        try:
+        with self._executor() as executor:
             graph = Graph(
                 objects=self.arch,
                 get_persistent_rep=self.get_persistent_rep,
                 robust_replace=self.robust_replace,
                 get_id=self.get_id,
+                executor=executor,
             )
-        except topsort.CycleError as err:
-            six.reraise(CycleError, CycleError(*err.args), sys.exc_info()[-1])
 
         # Optionally: at this stage perform a graph reduction.
         graph.reduce()
@@ -1250,17 +1487,48 @@ class Archive(object):
         ]
 
         # Add any leftover names (aliases):
+        names = set(_name for (_name, _rep) in names_reps)
         names_reps.extend(
             [
-                (name, node.name)
+                (name, graph.nodes[self.ids[name]].name)
                 for name in self.ids
-                if name not in list(zip(*names_reps))[0]
-                for node in [graph.nodes[self.ids[name]]]
+                if name not in names
             ]
         )
 
         return (graph.imports, names_reps)
 
+    @contextmanager
+    def _executor(self):
+        r"""Context yielding a thread pool as specified by :attr:`max_workers`
+        or `None`.
+
+        In the latter case the graph is built serially, so the numpy print
+        options are set here once rather than for each array.
+        """
+        if self.max_workers:
+            with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+                yield executor
+        elif np is None or self._printoptions_set:
+            yield None
+        else:
+            with np.printoptions(**self._numpy_printoptions):
+                self._printoptions_set = True
+                try:
+                    yield None
+                finally:
+                    self._printoptions_set = False
+
+    def __getstate__(self):
+        # The lock cannot be pickled or copied.
+        state = dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
     def __repr__(self):
         return str(self)
 
@@ -1277,16 +1545,14 @@ class Archive(object):
             assert iname is not None or uiname is not None
             if iname is None:
                 import_lines.append("import {} as {}".format(module, uiname))
-                del_lines.append("del {}".format(uiname))
             elif iname == uiname or uiname is None:  # pragma: no cover
                 # Probably never happens because uinames start with _
                 import_lines.append("from {} import {}".format(module, uiname))
-                del_lines.append("del {}".format(uiname))
             else:
                 import_lines.append(
                     "from {} import {} as {}".format(module, iname, uiname)
                 )
-                del_lines.append("del {}".format(uiname))
+            del_lines.append("del {}".format(uiname))
         return import_lines, del_lines
 
     def __str__(self):
@@ -1314,17 +1580,18 @@ class Archive(object):
         imports, defs = self.make_persistent()
 
         import_lines, del_lines = self._get_import_lines(imports)
+        allowed_names = set(self.allowed_names)
         temp_names = [
             name
             for (name, rep) in defs
-            if (name.startswith("_") and name not in self.allowed_names)
+            if (name.startswith("_") and name not in allowed_names)
         ]
         if temp_names:
             del_lines.append("del %s" % (",".join(temp_names),))
 
         del_lines.extend(self._get_del_lines())
 
-        lines = "\n".join(["{} = {}".format(uname, rep) for (uname, rep) in defs])
+        lines = "\n".join(map(" = ".join, defs))
         imports = "\n".join(import_lines)
         dels = "\n".join(del_lines)
 
@@ -1336,16 +1603,16 @@ class Archive(object):
     def scoped__str__(self):
         r"""Return the scoped version of the string representation."""
         # Generate dependency graph
-        try:
+        allowed_names = set(self.allowed_names)
+        with self._executor() as executor:
             graph = _Graph(
                 objects=self.arch,
                 get_persistent_rep=self.get_persistent_rep,
                 gname_prefix=self.gname_prefix,
-                allowed_names=set(self.allowed_names),
+                allowed_names=allowed_names,
                 get_id=self.get_id,
+                executor=executor,
             )
-        except topsort.CycleError as err:
-            six.reraise(CycleError, CycleError(*err.args), sys.exc_info()[-1])
 
         # Optionally: at this stage perform a graph reduction.
         # graph.reduce()
@@ -1360,17 +1627,9 @@ class Archive(object):
 
             if node.args or node.imports:
                 results.append(
-                    "\n".join(
-                        [
-                            "",
-                            "def %(name)s(%(args)s):%(imports)s",
-                            "    return %(rep)s",
-                            "%(name)s = %(name)s()",
-                        ]
-                    )
+                    _SCOPED_DEF_TEMPLATE
                     % dict(
                         name=name,
-                        argnames=",".join(sorted(node.args)),
                         args=",".join(
                             [
                                 "=".join(
@@ -1386,7 +1645,7 @@ class Archive(object):
                     )
                 )
             else:
-                results.append("%(name)s = %(rep)s" % dict(name=name, rep=node.rep))
+                results.append(" = ".join([name, node.rep]))
 
         # Add any leftover names (aliases):
         for name in self.ids:
@@ -1398,7 +1657,7 @@ class Archive(object):
         gnames = ", ".join(
             _n
             for _n in names
-            if _n.startswith(self.gname_prefix) and _n not in self.allowed_names
+            if _n.startswith(self.gname_prefix) and _n not in allowed_names
         )
         if gnames:
             results.append("del %s" % (gnames,))
@@ -1406,13 +1665,18 @@ class Archive(object):
 
         return "\n".join(results)
 
-    def save_data(self, datafile=None, filename=None, data_format="npy"):
+    def save_data(
+        self, datafile=None, filename=None, data_format="npy", mmap_mode=None
+    ):
         """Save any arrays in `self.data` to disk.
 
         Arguments
         ---------
         data_format : 'npy', 'npz', 'hdf5
             Data format used to store binary data.
+        mmap_mode : None, 'r', 'c'
+            Memory map `npy` arrays when loading.  See
+            :meth:`ArrayManager.save_arrays`.
         """
         files = []
         rep = None
@@ -1429,6 +1693,7 @@ class Archive(object):
                     filename=filename,
                     keep=self.backup_data,
                     data_format=data_format,
+                    mmap_mode=mmap_mode,
                 )
             else:
                 warnings.warn(
@@ -1449,6 +1714,7 @@ class Archive(object):
         data_format="npy",
         force=False,
         clear_on_reload=True,
+        mmap_mode=None,
     ):
         """Save the archive to disk as an importable package or module.
 
@@ -1484,6 +1750,9 @@ class Archive(object):
            If `True`, then a search of `sys.modules` is made for any submodules
            that are not modules and these are deleted so they can be properly
            reloaded.  This is mainly intended for DataSet usage.
+        mmap_mode : None, 'r', 'c'
+           Memory map `npy` arrays when loading.  See
+           :meth:`ArrayManager.save_arrays`.
         """
         # First form the string - this will populate self.data if needed (we
         # need this for the following checks.
@@ -1491,7 +1760,7 @@ class Archive(object):
 
         if name is None:
             if self.single_item_mode:
-                name = self.names()[0]
+                name = self.arch[0][0]
             else:
                 raise ValueError("Must provide name unless single_item_mode=True")
 
@@ -1548,31 +1817,55 @@ class Archive(object):
                 os.makedirs(package_dir)
 
         array_rep, array_files = self.save_data(
-            datafile=package_dir, filename=arrays_file, data_format=data_format
+            datafile=package_dir,
+            filename=arrays_file,
+            data_format=data_format,
+            mmap_mode=mmap_mode,
         )
-        with backup(init_file, keep=self.backup_data):
-            with open(init_file, "w") as f:
-                if array_rep:
-                    f.write(array_rep)
-                f.write(string_rep)
-                if self.single_item_mode:
-                    assert 1 == len(self.arch)
-                    # Special case of a single item archive.  Make module the
-                    # single object.
-                    f.write(
-                        "\n".join(
-                            [
-                                "",
-                                "import sys",
-                                "sys.modules[__name__] = {NAME}".format(
-                                    NAME=self.names()[0]
-                                ),
-                            ]
-                        )
-                    )
-                elif clear_on_reload:
-                    # clear all special single item imports
-                    f.write(_G_CLEAR_SINGLE_ITEM_MODULES_CODE)
+        contents = self._get_module_contents(
+            string_rep, array_rep=array_rep, clear_on_reload=clear_on_reload
+        )
+
+        if not array_files and _unchanged(init_file, contents):
+            # Don't rewrite (or back up) an identical file.  This is common with
+            # DataSet where the info is often reassigned unchanged.
+            return
+
+        with replace_file(init_file, keep=self.backup_data) as tmp_name:
+            with open(tmp_name, "w") as f:
+                f.write(contents)
+
+    def _get_module_contents(self, string_rep, array_rep, clear_on_reload):
+        r"""Return the contents of the module written by :meth:`save`."""
+        contents = [string_rep]
+        if array_rep:
+            contents.insert(0, array_rep)
+        if self.single_item_mode:
+            assert 1 == len(self.arch)
+            # Special case of a single item archive.  Make module the
+            # single object.
+            contents.append(
+                "\n".join(
+                    [
+                        "",
+                        "import sys",
+                        "sys.modules[__name__] = {NAME}".format(NAME=self.arch[0][0]),
+                    ]
+                )
+            )
+        elif clear_on_reload:
+            # clear all special single item imports
+            contents.append(_G_CLEAR_SINGLE_ITEM_MODULES_CODE)
+        return "".join(contents)
+
+
+def _unchanged(filename, contents):
+    r"""Return `True` if the file `filename` exists and contains `contents`."""
+    try:
+        with open(filename) as f:
+            return f.read() == contents
+    except FileNotFoundError:
+        return False
 
 
 _G_CLEAR_SINGLE_ITEM_MODULES_CODE = '''
@@ -1635,9 +1928,9 @@ def get_toplevel_imports(obj, env=None):
     >>> get_toplevel_imports(a)
     ([('numpy...', 'array', 'array')], 'array')
     """
-    module = inspect.getmodule(obj)
+    module = get_module(obj)
     if module is None:
-        module = inspect.getmodule(obj.__class__)
+        module = get_module(obj.__class__)
 
     mname = module.__name__
     name = obj.__name__
@@ -1677,7 +1970,17 @@ def repr_(obj, robust=True):
 
 
 def get_module(obj):
-    r"""Return module in which object is defined."""
+    r"""Return module in which object is defined.
+
+    Objects defining `__module__` are looked up directly in :data:`sys.modules`.
+    Only other objects go through :func:`inspect.getmodule` which may scan all
+    loaded modules.
+    """
+    if isinstance(obj, types.ModuleType):
+        return obj
+    mname = getattr(obj, "__module__", None)
+    if mname is not None:
+        return sys.modules.get(mname, None)
     return inspect.getmodule(obj)
 
 
@@ -1711,15 +2014,16 @@ def get_persistent_rep_repr(obj, env, rep=None):
     imports = []
     args = {}
 
-    module = get_module(obj.__class__)
-    scope = copy.copy(module.__dict__)
-    scope.update(env)
+    # A view rather than a copy: module dicts (e.g. numpy) can be large.
+    # The names are plain identifiers, so a lookup replaces eval().
+    scope = ChainMap(env, get_module(obj.__class__).__dict__, vars(builtins))
     rep = repr(obj)
 
-    _ast = AST(rep)
-
-    for name in _ast.names:
-        obj = eval(name, scope)
+    for name in unique_list(_get_names(rep)):
+        if name in scope:
+            obj = scope[name]
+        else:
+            obj = eval(name, {}, scope)  # Raises the usual NameError
         module = get_module(obj)
         if module:
             imports.append((module.__name__, name, name))
@@ -1735,6 +2039,35 @@ def get_persistent_rep_pickle(obj, env):
     return (rep, args, imports)
 
 
+_MODULE_NAMES = {}  # See _get_module_name()
+
+
+def _get_module_name(module, obj):
+    r"""Return the name of `obj` in `module` or `None`.
+
+    The mapping from ids to names for each module is cached and rebuilt if
+    the module dictionary has changed.
+
+    >>> _get_module_name(types, types.FunctionType)
+    'FunctionType'
+    >>> _get_module_name(types, int) is None
+    True
+    """
+    module_dict = module.__dict__
+    entry = _MODULE_NAMES.get(module.__name__, None)
+    if entry is None or entry[0] != len(module_dict):
+        names = {}
+        for _name, _obj in module_dict.items():
+            names.setdefault(id(_obj), _name)
+        entry = _MODULE_NAMES[module.__name__] = (len(module_dict), names)
+    name = entry[1].get(id(obj), None)
+    if name is not None and module_dict.get(name, None) is not obj:
+        # Name was rebound: rebuild the cache.
+        del _MODULE_NAMES[module.__name__]
+        return _get_module_name(module, obj)
+    return name
+
+
 def get_persistent_rep_type(obj, env):
     # Special cases
     if type(None) is obj:
@@ -1742,10 +2075,8 @@ def get_persistent_rep_type(obj, env):
     name = None
     args = {}
     for module in [builtins, types]:
-        obj_id = id(obj)
-        val_ids = list(map(id, module.__dict__.values()))
-        if obj_id in val_ids:
-            name = module.__dict__[val_ids.index(obj_id)]
+        name = _get_module_name(module, obj)
+        if name is not None:
             imports = [(module.__name__, name, name)]
             rep = name
             break
@@ -1766,9 +2097,14 @@ def get_persistent_rep_float(obj, env):
     --------
     >>> get_persistent_rep_float(np.inf, {})
     ('inf', {}, [('numpy', 'inf', 'inf')])
+    >>> get_persistent_rep_float(1.5, {})
+    ('1.5', {}, [])
     """
     rep = repr(obj)
-    imports = [("numpy", name, name) for name in AST(rep)._get_names()]
+    if obj.__class__ in (float, complex) and cmath.isfinite(obj):
+        # Finite numbers are plain literals so there is nothing to import.
+        return (rep, {}, [])
+    imports = [("numpy", name, name) for name in AST(rep).names]
     args = {}
 
     return (rep, args, imports)
@@ -1782,10 +2118,7 @@ def get_persistent_rep_obj(obj, env):
 
 def get_persistent_rep_method(obj, env):
     r"""Archive methods."""
-    if sys.version_info < (3, 0):  # pragma: no cover
-        instance = obj.im_self
-    else:
-        instance = obj.__self__
+    instance = obj.__self__
     cls = instance.__class__
     name = obj.__name__
 
@@ -1803,7 +2136,7 @@ def get_persistent_rep_method(obj, env):
 def get_persistent_rep_classmethod(obj, env):
     r"""Archive methods."""
     rep = obj.__qualname__
-    module = inspect.getmodule(obj)
+    module = get_module(obj)
     mname = module.__name__
     cname, _name = rep.split(".", 1)
     imports = [(mname, cname, cname)]
@@ -1822,17 +2155,14 @@ def _get_rep(obj, arg_rep):
 
 
 def get_persistent_rep_list(xs, env):
-    args = {}
     imports = []
-    name = "_l_0"
-    names = set(env)
-    reps = []
-    unames = UniqueNames(names).unique_names(name)
-    for o in xs:
-        name = next(unames)
-        args[name] = o
-        names.add(name)
-        reps.append(name)
+    if env:
+        unames = UniqueNames(env).unique_names("_l_0")
+        reps = [next(unames) for _o in xs]
+    else:
+        # Nothing to clash with: these are the names UniqueNames would give.
+        reps = ["_l_%i" % (_n,) for _n in range(len(xs))]
+    args = dict(zip(reps, xs))
 
     rep = "[{}]".format(", ".join(reps))
 
@@ -1877,26 +2207,18 @@ def is_simple(obj):
     >>> list(map(is_simple,
     ...          [[1], (1, ), {'a':2}]))
     [False, True, False]
+    >>> list(map(is_simple,
+    ...          [float('inf'), complex(1, float('nan')), (1, float('nan'))]))
+    [False, False, False]
     """
-    if hasattr(obj, "__class__"):
-        class_ = obj.__class__
-        classes = [bool, int, str, None.__class__]
-        if sys.version_info < (3, 0):  # pragma: no cover
-            classes.extend([long, unicode])
-        result = (
-            class_ in classes
-            or (
-                class_ in [float, complex]
-                and not (np and (np.isinf(obj)) or np.isnan(obj))
-            )
-            or (class_ == tuple and all(map(is_simple, obj)))
-        )
-    else:  # pragma: no cover
-        result = False
-    if result:
-        assert obj == eval(repr(obj))
-
-    return result
+    class_ = type(obj)
+    if class_ in _SIMPLE_TYPES:
+        return True
+    elif class_ is float or class_ is complex:
+        return cmath.isfinite(obj)
+    elif class_ is tuple:
+        return all(map(is_simple, obj))
+    return False
 
 
 class Node(object):
@@ -1917,19 +2239,36 @@ class Node(object):
        In this case it is imperative that each instance of an object in `rep`
        has a unique identifier, even if it refers to the same object in memory.
     parents : list
-       List of parent id's
+       List of parent id's with one entry per edge, so a parent referring
+       to this node twice appears twice.  :meth:`isreducible` relies on this
+       count, so this cannot be a set (or bitmask) of ids.
+    id : int
+       Id of :attr:`obj` as returned by `get_id`.  This is computed once.
     """
 
+    __slots__ = (
+        "get_id",
+        "id",
+        "obj",
+        "rep",
+        "args",
+        "name",
+        "children",
+        "parents",
+        "imports",
+    )
+
     def __init__(
         self, obj, rep, args, name, imports=None, children=None, parents=None, get_id=id
     ):
         self.get_id = get_id
         self.obj = obj
+        self.id = get_id(obj)
         self.rep = rep
-        self.args = dict(**args)
+        self.args = dict(args)
         self.name = name
         if children is None:
-            children = [self.get_id(self.args[_name]) for _name in self.args]
+            children = list(map(get_id, self.args.values()))
         self.children = children
         if parents is None:
             parents = []
@@ -1968,11 +2307,6 @@ class Node(object):
         """
         return "Node({}={})".format(self.name, self.rep)
 
-    @property
-    def id(self):
-        r"""id of node."""
-        return self.get_id(self.obj)
-
     def isreducible(self, roots):
         r"""Return `True` if the node can be reduced.
 
@@ -1980,7 +2314,7 @@ class Node(object):
         object with an efficient representation (as defined by
         :meth:`is_simple`), or has exactly one parent."""
         reducible = self.id not in roots and (
-            is_simple(self.obj) or 1 == len(self.parents)
+            1 == len(self.parents) or is_simple(self.obj)
         )
         return reducible
 
@@ -1997,36 +2331,79 @@ class GraphMixin(object):
 
     def _DFS(self, node, env):
         r"""Visit all nodes in the directed subgraph specified by
-        node, and insert them into nodes."""
-        for _name in node.args:
-            obj = node.args[_name]
+        node, and insert them into nodes.
+
+        The search uses an explicit stack of :meth:`_new_children` generators
+        rather than recursion so that deeply nested objects do not exceed the
+        recursion limit.  Nodes are created in the same (pre-)order.
+        """
+        stack = [self._new_children(node, env)]
+        while stack:
+            new_node = next(stack[-1], None)
+            if new_node is None:
+                stack.pop()
+            else:
+                stack.append(self._new_children(new_node, env))
+
+    def _new_children(self, node, env):
+        r"""Generate the nodes for the children of `node` not yet in nodes.
+
+        Each node is created and inserted into nodes only when requested so
+        that the descendants of earlier children are visited first.
+        """
+        objs = OrderedDict()
+        for obj in node.args.values():
             id_ = self.get_id(obj)
             if id_ not in self.nodes:
-                new_node = self._new_node(obj, env, self.gname(obj))
+                objs.setdefault(id_, obj)
+        reps = self._get_persistent_reps([(obj, env) for obj in objs.values()])
+        for (id_, obj), rep in zip(objs.items(), reps):
+            if id_ not in self.nodes:
+                new_node = self._new_node(obj, env, self.gname(obj), rep=rep)
                 self.nodes[id_] = new_node
-                self._DFS(new_node, env)
+                yield new_node
+
+    def _get_persistent_reps(self, objs_envs):
+        r"""Return a list with `(rep, args, imports)` for each `(obj, env)` in
+        `objs_envs` computed concurrently with :attr:`executor`.
+
+        Without an executor the entries are `None` so that the representations
+        are computed lazily in the usual order by :meth:`_new_node`.  The same
+        is done for objects whose handler raises :exc:`_Deferred`.
+        """
+        if self.executor is None or len(objs_envs) < 2:
+            return [None] * len(objs_envs)
+
+        def get_persistent_rep(obj_env):
+            _CONCURRENT.active = True
+            try:
+                return self.get_persistent_rep(*obj_env)
+            except _Deferred:
+                return None
+            finally:
+                _CONCURRENT.active = False
+
+        return list(self.executor.map(get_persistent_rep, objs_envs))
 
     def _process_imports(self, rep, args, imports):
         r"""Process imports and add them to self.imports,
         changing names as needed so there are no conflicts
         between `args = {name: obj}` and `self.names`.
         """
-        arg_names = sorted(args)
-
         # Check for duplicate imports
         replacements = {}
         for module_, iname_, uiname_ in imports:
-            mod_inames = list(zip(*_unzip(self.imports)[:2]))
-            if (module_, iname_) in mod_inames:
+            ind = self._import_index.get((module_, iname_), None)
+            if ind is not None:
                 # Import already specified.  Just refer to it
-                ind = mod_inames.index((module_, iname_))
                 module, iname, uiname = self.imports[ind]
             else:
                 # Get new name.  All import names are local
                 uiname = uiname_
                 if not uiname.startswith("_"):
                     uiname = "_" + uiname
-                uiname = self.names.unique(uiname, arg_names)
+                uiname = self.names.unique(uiname, args)
+                self._import_index[(module_, iname_)] = len(self.imports)
                 self.imports.append((module_, iname_, uiname))
 
             if not uiname == uiname_:
@@ -2047,11 +2424,43 @@ class GraphMixin(object):
 
     def _topological_order(self):
         r"""Return a list of the ids for all nodes in the graph in a
-        topological order."""
-        order = topsort.topsort(self.edges())
+        topological order.
+
+        Uses Kahn's algorithm which is `O(V + E)`: starting from the nodes
+        without parents, nodes are appended once all of their parents have
+        been.  The result is then reversed so that children come first.
+        """
+        nodes, get_id = self.nodes, self.get_id
+        num_parents = {}  # id -> number of edges from parents
+        children = {}  # id -> list of children ids (one entry per edge)
+        for id_ in nodes:
+            args = nodes[id_].args
+            if not args:
+                continue
+            num_parents.setdefault(id_, 0)
+            children[id_] = _children = [get_id(obj) for obj in args.values()]
+            for child in _children:
+                num_parents[child] = num_parents.get(child, 0) + 1
+
+        queue = deque([id_ for id_ in num_parents if num_parents[id_] == 0])
+        order = []
+        while queue:
+            parent = queue.popleft()
+            order.append(parent)
+            for child in children.get(parent, ()):
+                num_parents[child] -= 1
+                if num_parents[child] == 0:
+                    queue.append(child)
+
+        if len(order) < len(num_parents):
+            # Every node not in order has a parent: there is a cycle.
+            raise CycleError(
+                order, {_id: _n for (_id, _n) in num_parents.items() if _n}
+            )
         order.reverse()
         # Insert roots (they may be disconnected)
-        order.extend([id for id in self.roots if id not in order])
+        ordered = set(order)
+        order.extend([id for id in self.roots if id not in ordered])
         return order
 
     def check(self):
@@ -2064,20 +2473,23 @@ class GraphMixin(object):
                 assert id in cnode.parents
 
     def paths(self, id=None):
-        """Return a list of all paths through the graph starting from `id`."""
-        paths = []
-        if id is None:
-            for r in self.roots:
-                paths.extend(self.paths(r))
-        else:
-            children = self.nodes[id].children
+        """Iterate over all paths through the graph starting from `id`.
+
+        Each path is yielded as a tuple of ids.  Traversal is an explicit
+        depth-first stack so deep graphs do not hit the recursion limit
+        and shared prefixes are not copied for every child path.  Use
+        ``list(graph.paths())`` if a list is needed.
+        """
+        nodes = self.nodes
+        roots = list(self.roots) if id is None else [id]
+        stack = [(_id, (_id,)) for _id in reversed(roots)]
+        while stack:
+            _id, path = stack.pop()
+            children = nodes[_id].children
             if not children:
-                paths.append([id])
+                yield path
             else:
-                for c in children:
-                    paths.extend([[id] + p for p in self.paths(c)])
-
-        return paths
+                stack.extend((_c, path + (_c,)) for _c in reversed(children))
 
     def _reduce(self, id):  # pragma: no cover
         raise NotImplementedError
@@ -2101,6 +2513,7 @@ class Graph(GraphMixin):
         gname_prefix="_g",
         allowed_names=set(),
         get_id=id,
+        executor=None,
     ):
         r"""Initialize the dependency graph with some reserved
         names.
@@ -2124,12 +2537,17 @@ class Graph(GraphMixin):
            imported as::
 
                 from module import iname as uiname
+        executor : concurrent.futures.Executor, optional
+           If provided, then the representations of sibling objects are
+           computed concurrently with this.
         """
         self.get_id = get_id
+        self.executor = executor
         self.nodes = {}
         self.roots = set()
         self.envs = {}
         self.imports = []
+        self._import_index = {}  # (module, iname) -> index into self.imports
         self.gname_prefix = gname_prefix
         self.allowed_names = allowed_names
 
@@ -2138,8 +2556,9 @@ class Graph(GraphMixin):
         self.robust_replace = robust_replace
 
         # First insert the root nodes
-        for name, obj, env in objects:
-            node = self._new_node(obj, env, name)
+        reps = self._get_persistent_reps([(obj, env) for (name, obj, env) in objects])
+        for (name, obj, env), rep in zip(objects, reps):
+            node = self._new_node(obj, env, name, rep=rep)
             self.roots.add(node.id)
             self.envs[node.id] = env
             self.nodes[node.id] = node
@@ -2151,10 +2570,14 @@ class Graph(GraphMixin):
         self.order = self._topological_order()
 
         # Go through all nodes to determine unique names and update
-        # reps.  Now that it is sorted we can do this simply.
+        # reps.  Now that it is sorted we can do this simply: children
+        # come before their parents so their names are final, and we
+        # record the parent links in the same pass.  (The children of a
+        # node are the ids of its args, in order.)
+        nodes, roots, get_id = self.nodes, self.roots, self.get_id
         for _id in self.order:
-            node = self.nodes[_id]
-            if _id in self.roots:
+            node = nodes[_id]
+            if _id in roots:
                 # Node is a root node.  Leave name alone
                 pass
             else:
@@ -2166,24 +2589,27 @@ class Graph(GraphMixin):
 
             replacements = {}
             args = {}
-            for name in node.args:
-                obj = node.args[name]
-                uname = self.nodes[self.get_id(obj)].name
+            for name, obj in node.args.items():
+                cnode = nodes[get_id(obj)]
+                cnode.parents.append(_id)
+                uname = cnode.name
                 args[uname] = obj
                 if not name == uname:
                     replacements[name] = uname
             node.args = args
 
-            for child in node.children:
-                cnode = self.nodes[child]
-                cnode.parents.append(node.id)
-
-            node.rep = _replace_rep(node.rep, replacements, robust=self.robust_replace)
+            if replacements:
+                node.rep = _replace_rep(
+                    node.rep, replacements, robust=self.robust_replace
+                )
 
-    def _new_node(self, obj, env, name):
+    def _new_node(self, obj, env, name, rep=None):
         r"""Return a new node associated with `obj` and using the
-        specified `name`.  Also process the imports of the node."""
-        rep, args, imports = self.get_persistent_rep(obj, env)
+        specified `name`.  Also process the imports of the node.  If `rep`
+        is not provided, then it is computed with :attr:`get_persistent_rep`."""
+        if rep is None:
+            rep = self.get_persistent_rep(obj, env)
+        rep, args, imports = rep
         rep = self._process_imports(rep, args, imports)
         return Node(
             obj=obj, rep=rep, args=args, name=name, imports=imports, get_id=self.get_id
@@ -2191,21 +2617,21 @@ class Graph(GraphMixin):
 
     def _reduce(self, id):
         r"""Reduce the node."""
-        node = self.nodes[id]
+        nodes = self.nodes
+        node = nodes[id]
         replacements = {node.name: node.rep}
         for parent in node.parents:
-            pnode = self.nodes[parent]
+            pnode = nodes[parent]
             pnode.rep = _replace_rep(
                 pnode.rep, replacements, robust=self.robust_replace
             )
             pnode.children.remove(id)
-            if node.name in pnode.args:
-                # It may have been removed already...
-                del pnode.args[node.name]
-
+            pnode.children.extend(node.children)
+            # It may have been removed already...
+            pnode.args.pop(node.name, None)
             pnode.args.update(node.args)
         for child in node.children:
-            cnode = self.nodes[child]
+            cnode = nodes[child]
             cnode.parents.remove(id)
             cnode.parents.extend(node.parents)
         del self.nodes[id]
@@ -2355,9 +2781,8 @@ class Graph(GraphMixin):
         except NameError: pass
         """
         self.check()
-        reducible_ids = [
-            id for id in self.order if self.nodes[id].isreducible(roots=self.roots)
-        ]
+        nodes, roots = self.nodes, self.roots
+        reducible_ids = [id for id in self.order if nodes[id].isreducible(roots=roots)]
         for id in reducible_ids:
             self._reduce(id)
 
@@ -2384,6 +2809,7 @@ class _Graph(GraphMixin):
         gname_prefix="_g",
         allowed_names=set(),
         get_id=id,
+        executor=None,
     ):
         r"""Initialize the dependency graph with some reserved
         names.
@@ -2407,12 +2833,17 @@ class _Graph(GraphMixin):
            imported as::
 
                 from module import iname as uiname
+        executor : concurrent.futures.Executor, optional
+           If provided, then the representations of sibling objects are
+           computed concurrently with this.
         """
         self.get_id = get_id
+        self.executor = executor
         self.nodes = {}
         self.roots = set()
         self.envs = {}
         self.imports = []
+        self._import_index = {}  # (module, iname) -> index into self.imports
         self.gname_num = 0
         self.gname_prefix = gname_prefix
         self.allowed_names = allowed_names
@@ -2421,8 +2852,9 @@ class _Graph(GraphMixin):
         self.names = set()
 
         # First insert the root nodes
-        for name, obj, env in objects:
-            node = self._new_node(obj, env, name)
+        reps = self._get_persistent_reps([(obj, env) for (name, obj, env) in objects])
+        for (name, obj, env), rep in zip(objects, reps):
+            node = self._new_node(obj, env, name, rep=rep)
             self.roots.add(node.id)
             self.envs[node.id] = env
             self.nodes[node.id] = node
@@ -2440,11 +2872,14 @@ class _Graph(GraphMixin):
                 cnode = self.nodes[child]
                 cnode.parents.append(node.id)
 
-    def _new_node(self, obj, env, name):
+    def _new_node(self, obj, env, name, rep=None):
         r"""Return a new node associated with `obj` and using the
-        specified `name`. Also process the imports of the node."""
+        specified `name`. Also process the imports of the node.  If `rep`
+        is not provided, then it is computed with :attr:`get_persistent_rep`."""
         self.names.add(name)
-        rep, args, imports = self.get_persistent_rep(obj, env)
+        if rep is None:
+            rep = self.get_persistent_rep(obj, env)
+        rep, args, imports = rep
         return Node(
             obj=obj, rep=rep, args=args, name=name, imports=imports, get_id=self.get_id
         )
@@ -2455,24 +2890,10 @@ class _Graph(GraphMixin):
     # paths = Graph.paths
 
 
-def _unzip(q, n=3):
-    r"""Unzip q to lists.
-
-    If len(q) = 0, then assumes that q was zipped from n lists.
-
-    Example:
-    >>> _unzip(list(zip([1, 2, 3], [4, 5, 6])))
-    [[1, 2, 3], [4, 5, 6]]
-    >>> _unzip([], n=3)
-    [[], [], []]
-    >>> _unzip([('a', 'b', 'c'), ('d', 'e', 'f')])
-    [['a', 'd'], ['b', 'e'], ['c', 'f']]
-
-    """
-    if 0 == len(q):
-        return [[]] * n
-    else:
-        return list(map(list, zip(*q)))
+@functools.lru_cache(maxsize=None)
+def _get_extension_re(sep):
+    r"""Return the compiled regex splitting `base + sep + number` names."""
+    return re.compile(r"(.*)%s(\d+)$" % re.escape(sep))
 
 
 class UniqueNames(object):
@@ -2489,7 +2910,7 @@ class UniqueNames(object):
            Set of names.  New names will not clash with these.
         """
         self.sep = sep
-        self.extension_re = re.compile(r"(.*)%s(\d+)$" % re.escape(sep))
+        self.extension_re = _get_extension_re(sep)
         self.names = set(names)
 
         # This is a dictionary of numbers associated with each base such that
@@ -2651,88 +3072,65 @@ def _replace_rep(rep, replacements, check=False, robust=True):
     ReplacementError: Replacement a->c: Expected 1, replaced 2
     >>> _replace_rep("a + 'a'", dict(a='c'))
     "c + 'a'"
+    >>> _replace_rep('numpy.inf + inf', dict(inf='_inf'), robust=False)
+    'numpy.inf + _inf'
+    >>> _replace_rep('f(a =1, b=a, c=(a == 1))', dict(a='c'), robust=False)
+    'f(a =1, b=c, c=(c == 1))'
 
     Notes
     -----
-    In order to improve the replacements and eliminate the possibility
-    of a replacement overwriting a previous replacement, we first
-    construct a string with % style replacements and the effect the
-    replacements.
+    All replacements are made in a single pass with a compiled regular
+    expression (see :func:`_get_replace_re`) so that a replacement cannot be
+    overwritten by a subsequent replacement.
     """
+    if not replacements:
+        return rep
+
     if robust:
         return _replace_rep_robust(rep, replacements)
 
     if check:
         rep_names = AST(rep).names
         counts = dict((n, rep_names.count(n)) for n in replacements)
+    n_reps = dict.fromkeys(replacements, 0)
 
-    identifier_tokens = string.ascii_letters + string.digits + "_"
-
-    if replacements:
-        # Replace all % characters so they are not interpreted as
-        # format specifiers in the final replacement
-        rep = rep.replace("%", "%%")
-
-    for old in replacements:
-        replacement_str = "%(" + old + ")s"
-        len_old = len(old)
-        i = rep.find(old)
-        i_rep = []  # Indices to replace
-        while 0 <= i:
-            prev = rep[i - 1 : i]
-            next = rep[i + len_old : i + len_old + 1]
-            if (not next or next not in identifier_tokens) and (
-                not prev or prev not in identifier_tokens
-            ):
-                # Now get previous and next non-whitespace characters
-                c = i + len_old
-                while c < len(rep) and rep[c] in string.whitespace:
-                    c = c + 1
-                next = rep[c : c + 1]
-
-                c = i - 1
-                while 0 <= c and rep[c] in string.whitespace:
-                    c = c - 1
-                prev = rep[c : c + 1]
-                if not next or next not in "=":
-                    # Test for keyword arguments
-                    i_rep.append(i)
-            i = rep.find(old, i + 1)
-
-        n_rep = len(i_rep)
-
-        parts = []
-        i0 = 0
-        for i in i_rep:
-            parts.append(rep[i0:i])
-            i0 = i + len_old
-        parts.append(rep[i0:])
-
-        rep = replacement_str.join(parts)
-
-        if check and not n_rep == counts[old]:
-            raise ReplacementError(old, replacements[old], counts[old], n_rep)
-
-    # Now do all the replacements en mass
-    if replacements:
-        rep = rep % replacements
-
-    # re_ = r'''(?P<a>        # Refer to the group by name <a>
-    #            [^\w\.]      # Either NOT a valid identifier
-    #            | ^)         # OR the start of the string
-    #           (%s)          # The literal to be matched
-    #           (?P<b>[^\w=]  # Either NOT a valid identifer
-    #            | $)'''      # OR the end.
-    # regexp = re.compile(re_%(re.escape(old)), re.VERBOSE)
-    # n_rep = 0
-    # while True:
-    #     (rep, m) = regexp.subn(r"\g<a>%s\g<b>"%(replacements[old]),rep)
-    #     if m == 0: break
-    #     n_rep += m
+    def repl(match):
+        old = match.group(0)
+        start = match.start()
+        if start and rep[start - 1] in _NOT_BEFORE_NAME:
+            return old  # Part of a longer identifier or an attribute
+        n_reps[old] += 1
+        return replacements[old]
+
+    rep = _get_replace_re(frozenset(replacements)).sub(repl, rep)
+
+    if check:
+        for old in replacements:
+            if not n_reps[old] == counts[old]:
+                raise ReplacementError(old, replacements[old], counts[old], n_reps[old])
 
     return rep
 
 
+@functools.lru_cache(maxsize=1024)
+def _get_replace_re(names):
+    r"""Return a compiled regex matching any of `names` not followed by an
+    identifier character or by `=` (so keyword arguments are not replaced).
+    Whitespace before the `=` is skipped by the regex itself, and `==` is
+    still a comparison.
+
+    The longest names are tried first.  The caller must check that the match is not
+    preceded by an identifier character or `.`: a lookbehind here would disable the
+    regex engine's literal prefix search and is several times slower.
+    """
+    alternatives = "|".join(map(re.escape, sorted(names, key=len, reverse=True)))
+    return re.compile(
+        r"(?:{})(?![A-Za-z0-9_])(?![{}]*=(?!=))".format(
+            alternatives, re.escape(string.whitespace)
+        )
+    )
+
+
 def _replace_rep_robust(rep, replacements):
     r"""Return rep with all replacements made.
 
@@ -2753,38 +3151,57 @@ def _replace_rep_robust(rep, replacements):
     '(c, c)'
     >>> _replace_rep_robust("a + 'a'", dict(a='c'))
     "c + 'a'"
+    >>> _replace_rep_robust("['é', a]", dict(a='c'))
+    "['é', c]"
+    >>> _replace_rep_robust("(a,\n a)", dict(a='c'))
+    '(c,\n c)'
 
     Notes
     -----
     This version is extremely robust, but very slow.  It uses the python parser.
     """
-    if not replacements:
+    if not any(_name in rep for _name in replacements):
         return rep
     names = [
         _n
         for _n in ast.walk(ast.parse(rep))
-        if _n.__class__ is ast.Name and _n.ctx.__class__ is not ast.Store
+        if _n.__class__ is ast.Name
+        and _n.id in replacements
+        and _n.ctx.__class__ is not ast.Store
     ]
     if not names:
         return rep
 
+    # The col_offset of nodes counts UTF-8 bytes.  The lengths agree only for ASCII
+    # reps (str.isascii() needs Python 3.7).
+    data = rep.encode("utf-8")
+    if len(data) == len(rep) and all(_n.lineno == 1 for _n in names):
+        # Common case: a one-line ASCII rep where col_offset indexes the str.
+        ind = 0
+        results = []
+        for _col, _id in sorted((_n.col_offset, _n.id) for _n in names):
+            results.append(rep[ind:_col])
+            results.append(replacements[_id])
+            ind = _col + len(_id)
+        results.append(rep[ind:])
+        return "".join(results)
+
+    # Otherwise we splice the encoded rep.
     line_offsets = [0]
-    for _line in rep.splitlines():
-        offset = line_offsets[-1] + len(_line) + 1  # include \n
-        line_offsets.append(offset)
-    splits = sorted((_n.lineno - 1, _n.col_offset, len(_n.id), _n.id) for _n in names)
+    for _line in data.splitlines(True):
+        line_offsets.append(line_offsets[-1] + len(_line))
+    splits = sorted((_n.lineno - 1, _n.col_offset, _n.id) for _n in names)
     ind = 0
     results = []
-    for _line, _col, _len, _id in splits:
+    for _line, _col, _id in splits:
         offset = line_offsets[_line] + _col
-        results.append(rep[ind:offset])
-        assert rep[offset:].startswith(_id)
-        assert _len == len(_id)
-        results.append(replacements.get(_id, _id))
-        ind = offset + _len
-    results.append(rep[ind:])
-    res = "".join(results)
-    return res
+        results.append(data[ind:offset])
+        _id_bytes = _id.encode("utf-8")
+        assert data.startswith(_id_bytes, offset)
+        results.append(replacements[_id].encode("utf-8"))
+        ind = offset + len(_id_bytes)
+    results.append(data[ind:])
+    return b"".join(results).decode("utf-8")
 
 
 class AST(object):
@@ -2792,8 +3209,7 @@ class AST(object):
 
     def __init__(self, expr):
         self.__dict__["expr"] = expr
-        self.__dict__["ast"] = ast.parse(expr)
-        self.__dict__["names"] = self._get_names()
+        self.__dict__["names"] = list(_get_names(expr))
 
     @property
     def expr(self):
@@ -2803,6 +3219,8 @@ class AST(object):
     @property
     def ast(self):
         r"""AST for expression"""
+        if "ast" not in self.__dict__:
+            self.__dict__["ast"] = ast.parse(self.expr)
         return self.__dict__["ast"]
 
     @property
@@ -2811,11 +3229,24 @@ class AST(object):
         return self.__dict__["names"]
 
     def _get_names(self):
-        return [
-            _n.id
-            for _n in ast.walk(ast.parse(self.expr))
-            if _n.__class__ is ast.Name and _n.ctx.__class__ is not ast.Store
-        ]
+        return list(_get_names(self.expr))
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_names(expr):
+    r"""Return a tuple of the symbols referenced in the expression `expr`.
+
+    The results are cached since the same short reps (`'inf'`, `'nan'`, etc.)
+    appear over and over in large archives.
+
+    >>> sorted(_get_names('f(x, y=inf) + x'))
+    ['f', 'inf', 'x', 'x']
+    """
+    return tuple(
+        _n.id
+        for _n in ast.walk(ast.parse(expr))
+        if _n.__class__ is ast.Name and _n.ctx.__class__ is not ast.Store
+    )
 
 
 class DataSet(object):
@@ -2995,6 +3426,7 @@ class DataSet(object):
     >>> shutil.rmtree(t)
 
     """
+
     _lock_file_name = "_locked"
 
     def __init__(
@@ -3010,6 +3442,9 @@ class DataSet(object):
         name_prefix="x_",
         timeout=60,
         scoped=True,
+        inline_nbytes=0,
+        mmap_mode=None,
+        background_writes=False,
     ):
         r"""Constructor.  Note that all of the parameters are stored
         as attributes with a leading underscore appended to the name.
@@ -3042,6 +3477,22 @@ class DataSet(object):
            specified in the `data_format` flag.
         data_format : 'npy', 'hdf5', 'npz'
            Format to use for storing arrays that exceed the array_threshold.
+        inline_nbytes : int
+           Arrays using at most this many bytes are stored in the attribute's
+           module rather than a separate data file, even if they exceed the
+           array_threshold.  (Each attribute has its own module, so this does
+           not affect loading of other attributes.)
+        mmap_mode : None, 'r', 'c'
+           If provided, then attributes stored with `data_format='npy'` are
+           memory mapped with this mode when loaded rather than read into
+           memory.  Use `'c'` if the loaded arrays need to be writable.
+        background_writes : bool
+           If `True`, then attributes assigned with `ds.x = ...` are written by
+           a background thread so that the caller can continue while the data
+           is written.  Writes are applied in order, and any other access to
+           the data set first waits for the pending writes, raising the first
+           error encountered (as does :meth:`close`).  The assigned values must
+           not be modified until they have been written.
         backup_data : bool
            If `True`, then backup copies of overwritten data will be
            saved.
@@ -3066,9 +3517,15 @@ class DataSet(object):
         self._synchronize = synchronize
         self._mode = mode
         self._array_threshold = array_threshold
+        self._inline_nbytes = inline_nbytes
+        self._mmap_mode = mmap_mode
         self._data_format = data_format
         self._module_name = module_name
         self._path = path
+        # Absolute paths so that later changes of the working directory (e.g.
+        # by other threads) do not affect the data set.
+        self._abs_path = os.path.abspath(path)
+        self._mod_dir = os.path.join(self._abs_path, module_name)
         self._backup_data = backup_data
         self._name_prefix = name_prefix
         self._info_dict = {}
@@ -3076,7 +3533,16 @@ class DataSet(object):
         self._maxint = -1
         self._closed = False
         self._lock_file = ""
+        self._state_lock = threading.RLock()  # Held by the thread in _ds_lock
+        self._lock_depth = 0  # Nesting of _ds_lock in the thread holding it
+        self._lock_owner = None  # threading.get_ident() of that thread
         self._scoped = scoped
+        self._code_cache = {}  # filename -> ((st_ino, st_mtime_ns, st_size), code)
+        self._info_dict_key = None  # _info_key() when _info_dict was loaded
+        self._background_writes = background_writes
+        self._writer = None  # Executor for background writes (created on use)
+        self._write_queue = deque()  # (name, value) waiting to be written
+        self._pending_writes = []  # Futures of the background writes
 
         mod_dir = os.path.join(path, module_name)
         key_file = os.path.join(mod_dir, "_this_dir_is_a_DataSet")
@@ -3112,10 +3578,6 @@ class DataSet(object):
 
         self._load()
 
-        # Needed for pre 2.6 python version to support tab completion
-        if sys.version_info < (2, 6):  # pragma: no cover
-            self.__members__ = sorted(self._info_dict)
-
     def _import(self, name="__init__"):
         """Return the attribute `name` from the dataset.
 
@@ -3125,37 +3587,22 @@ class DataSet(object):
            Name of attribute.  The default value `__init__` will load the
            `_info_dict`.
         """
-        archive_file = os.path.join(
-            self._path, self._module_name, "{:s}.py".format(name)
-        )
-        if os.path.exists(archive_file):
+        archive_file = os.path.join(self._mod_dir, "{:s}.py".format(name))
+        code = self._compile(archive_file)
+        if code is not None:
             _mod = UniqueNames(sys.modules).unique(name)
 
-            # Bytecode is written in parallel, thus there is a chance that
-            # changing the attribute to quickly will invalidate the .pyc file
-            # if the .py file is written before the original byte compilation
-            # process finishes.  For now, we disable byte compilation
-            # https://docs.python.org/2/library/sys.html#sys.dont_write_bytecode
-            _dont_write_bytecode = sys.dont_write_bytecode
-            sys.dont_write_bytecode = True
-            try:
-                if sys.version_info < (3, 0):  # pragma: no cover
-                    import imp
-
-                    res = imp.load_source(_mod, archive_file)
-                else:
-                    import importlib.util
-
-                    spec = importlib.util.spec_from_file_location(_mod, archive_file)
-                    res = importlib.util.module_from_spec(spec)
-                    spec.loader.exec_module(res)
-                if name == "__init__":
-                    res = res._info_dict
-                else:
-                    res = sys.modules[_mod]
-                    del sys.modules[_mod]
-            finally:
-                sys.dont_write_bytecode = _dont_write_bytecode
+            # We execute the code ourselves rather than through the import
+            # system so that no bytecode is written: it could be invalidated
+            # by a rewrite of the .py file before the byte compilation
+            # finishes.
+            spec = importlib.util.spec_from_file_location(_mod, archive_file)
+            res = importlib.util.module_from_spec(spec)
+            exec(code, res.__dict__)
+            if name == "__init__":
+                res = res._info_dict
+            else:
+                res = sys.modules.pop(_mod)
         else:
             if name == "__init__":
                 res = {}
@@ -3163,9 +3610,78 @@ class DataSet(object):
                 res = None
         return res
 
+    def _compile(self, archive_file):
+        r"""Return the compiled code for `archive_file` or `None` if it does not
+        exist.
+
+        The code is cached and only recompiled if the file has changed on disk.
+        Rewrites go through :func:`replace_file`, which creates a new file, so
+        the inode is included in the key as well as the modification time.
+
+        The code is also stored with :mod:`marshal` in the `__pycache__`
+        directory (like a `.pyc` file, but validated with the same key) so
+        that other instances and processes need not compile it again.
+        """
+        try:
+            st = os.stat(archive_file)
+        except FileNotFoundError:
+            self._code_cache.pop(archive_file, None)
+            return None
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = self._code_cache.get(archive_file, None)
+        if cached is None or cached[0] != key:
+            code_file = os.path.join(
+                os.path.dirname(archive_file),
+                "__pycache__",
+                "{}.{}.persist".format(
+                    os.path.basename(archive_file), sys.implementation.cache_tag
+                ),
+            )
+            code = None
+            try:
+                with open(code_file, "rb") as f:
+                    _key, code = marshal.load(f)
+                if _key != key:
+                    code = None
+            except Exception:
+                # Missing or from an interrupted write: just compile.
+                pass
+
+            if code is None:
+                with open(archive_file, "rb") as f:
+                    code = compile(f.read(), archive_file, "exec", dont_inherit=True)
+                try:
+                    os.makedirs(os.path.dirname(code_file), exist_ok=True)
+                    with replace_file(code_file) as tmp_name:
+                        with open(tmp_name, "wb") as f:
+                            marshal.dump((key, code), f)
+                except OSError:
+                    # E.g. a read-only data set.  The code is still cached here.
+                    pass
+            self._code_cache[archive_file] = cached = (key, code)
+        return cached[1]
+
     def _load(self):
-        r"""Create the data set from an existing repository."""
+        r"""Create the data set from an existing repository.
+
+        This is a single :func:`os.stat` if `__init__.py` has not changed since
+        the last load.
+        """
+        key = self._info_key()
+        if key is not None and key == self._info_dict_key:
+            return
         self._info_dict = self._import()
+        self._info_dict_key = key
+
+    def _info_key(self):
+        r"""Return a key identifying the current `__init__.py` file or `None` if
+        it does not exist."""
+        init_file = os.path.join(self._mod_dir, "__init__.py")
+        try:
+            st = os.stat(init_file)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
 
     def _lock(self):
         r"""Actually write the lock file, waiting for timeout if  needed.
@@ -3175,25 +3691,28 @@ class DataSet(object):
         if self._closed:
             raise IOError("DataSet has been closed")
 
-        lock_file = os.path.join(self._path, self._module_name, self._lock_file_name)
-
-        if os.path.exists(lock_file):
-            tic = time.time()
-            # Archive locked
-            while time.time() - tic < self._timeout:
-                if not os.path.exists(lock_file):
-                    # Lock release, so make lock-file
-                    open(lock_file, "w").close()
-                    self._lock_file = lock_file
-                    return
-                time.sleep(0.5)
-            # Timeout
-            raise IOError(
-                "DataSet locked.  Please close or remove lock '%s'" % (lock_file,)
-            )
-        else:
-            open(lock_file, "w").close()
-            self._lock_file = lock_file
+        lock_file = os.path.join(self._mod_dir, self._lock_file_name)
+
+        # Creating the file with O_EXCL checks and takes the lock atomically.
+        # While locked, we poll with exponential backoff so that short waits are
+        # not rounded up to a long sleep.
+        deadline = time.monotonic() + self._timeout
+        delay = 0.001
+        while True:
+            try:
+                os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise IOError(
+                        "DataSet locked.  Please close or remove lock '%s'"
+                        % (lock_file,)
+                    )
+                time.sleep(min(delay, remaining))
+                delay = min(2 * delay, 0.5)
+            else:
+                self._lock_file = lock_file
+                return
 
     def _unlock(self):
         r"""Actually remove the lock file."""
@@ -3206,26 +3725,48 @@ class DataSet(object):
 
     @contextmanager
     def _ds_lock(self):
-        r"""Lock the data set for writing."""
-        try:
-            if self._synchronize:
-                if self._lock_file:
-                    raise NotImplementedError(
-                        "Lock already established! " + "(Reentry not supported)"
-                    )
-                else:
+        r"""Lock the data set for writing.
+
+        Threads sharing this instance wait for each other on `_state_lock`.  The
+        thread holding the lock may enter again: only the outermost call takes
+        and releases the lock file.
+        """
+        with self._state_lock:
+            if self._lock_depth == 0:
+                if self._synchronize:
                     self._lock()
-            else:
-                # Lock should have been established upon construction
-                if not self._lock_file or not os.path.exists(self._lock_file):
+                elif not self._lock_file or not os.path.exists(self._lock_file):
+                    # Lock should have been established upon construction
                     raise IOError("Lost lock on %s!" % self._lock_file)
-            yield
-        finally:
-            r"""Reset the data set writing lock."""
-            if self._synchronize:
-                self._unlock()
+            self._lock_depth += 1
+            self._lock_owner = threading.get_ident()
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    self._lock_owner = None
+                    if self._synchronize:
+                        self._unlock()
+
+    def _flush(self):
+        r"""Wait for all pending background writes, raising the first error.
+
+        If this thread holds the lock, the writer would wait for it, so the
+        queued writes are done here instead.
+        """
+        if self._lock_owner == threading.get_ident():
+            self._write_queued()
+            return
+        if not self._pending_writes:
+            return
+        pending, self._pending_writes = self._pending_writes, []
+        concurrent.futures.wait(pending)
+        for future in pending:
+            future.result()
 
     def __iter__(self):
+        self._flush()
         return self._info_dict.__iter__()
 
     def __dir__(self):
@@ -3243,6 +3784,7 @@ class DataSet(object):
                 "'%s' object has no attribute '%s'" % (self.__class__.__name__, name)
             )
 
+        self._flush()
         return self._import(name)
 
     def __setattr__(self, name, value):
@@ -3254,39 +3796,89 @@ class DataSet(object):
         if self._mode == "r":
             raise ValueError("DataSet opened in read-only mode.")
 
+        if self._background_writes:
+            if self._writer is None:
+                self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self._write_queue.append((name, value))
+            self._pending_writes.append(self._writer.submit(self._write_queued))
+        else:
+            self._write_attr(name, value)
+
+    def _write_queued(self):
+        r"""Write the attributes in `_write_queue` in order.
+
+        The queue is only emptied with the lock held, so each entry is written
+        once, either by the writer thread or by :meth:`_flush`.
+        """
+        with self._ds_lock():
+            while self._write_queue:
+                self._write_attr(*self._write_queue.popleft())
+
+    def _write_attr(self, name, value):
+        r"""Write attribute `name` and add it to the info if needed."""
         with self._ds_lock():  # Establish lock
-            arch = Archive(
-                array_threshold=self._array_threshold,
-                single_item_mode=True,
-                scoped=self._scoped,
-                backup_data=self._backup_data,
-            )
-            arch.insert(**{name: value})
-            arch.save(
-                dirname=os.path.join(self._path, self._module_name),
-                name=name,
-                package=False,
-                data_format=self._data_format,
-                force=True,
-                arrays_name="_data",
-            )
+            self._save_attr(name, value)
+            if self._synchronize:
+                self._load()
 
-        # Needed for pre 2.6 python version to support tab completion
-        if sys.version_info < (2, 6):  # pragma: no cover
-            self.__members__.append(name)
+            if name not in self._info_dict:
+                # Set default info to None.
+                self._info_dict_key = None
+                self._info_dict[name] = None
+                self._save_info_dict()
+
+    def _save_attr(self, name, value):
+        r"""Write the module for attribute `name`.  The lock must be held."""
+        self._code_cache.pop(os.path.join(self._mod_dir, name + ".py"), None)
+        arch = Archive(
+            array_threshold=self._array_threshold,
+            inline_nbytes=self._inline_nbytes,
+            single_item_mode=True,
+            scoped=self._scoped,
+            backup_data=self._backup_data,
+        )
+        arch.insert(**{name: value})
+        arch.save(
+            dirname=self._mod_dir,
+            name=name,
+            package=False,
+            data_format=self._data_format,
+            force=True,
+            arrays_name="_data",
+            mmap_mode=self._mmap_mode,
+        )
 
-        if name not in self._info_dict:
-            # Set default info to None.
-            self[name] = None
+    def _save_info_dict(self):
+        r"""Write `_info_dict` to the module `__init__.py` file.  The lock must
+        be held."""
+        if not self._module_name:
+            return
+        self._code_cache.pop(os.path.join(self._mod_dir, "__init__.py"), None)
+        arch = Archive(
+            allowed_names=["_info_dict"],
+            scoped=self._scoped,
+            backup_data=self._backup_data,
+        )
+        arch.insert(_info_dict=self._info_dict)
+        arch.save(
+            dirname=self._abs_path,
+            name=self._module_name,
+            package=True,
+            data_format=self._data_format,
+            force=True,
+        )
+        self._info_dict_key = self._info_key()
 
     def __contains__(self, name):
         r"""Fast containment test."""
+        self._flush()
         if self._synchronize:
             self._load()
         return name in self._info_dict
 
     def __getitem__(self, name):
         r"""Return the info associate with `name`."""
+        self._flush()
         if self._synchronize:
             self._load()
         return self._info_dict[name]
@@ -3298,28 +3890,39 @@ class DataSet(object):
         if self._mode == "r":
             raise ValueError("DataSet opened in read-only mode.")
 
+        self._flush()
         with self._ds_lock():
             if self._synchronize:
                 self._load()
 
+            # The in-memory info no longer matches the file until it is saved.
+            self._info_dict_key = None
             self._info_dict[name] = info
+            self._save_info_dict()
 
-            if self._module_name:
-                arch = Archive(
-                    allowed_names=["_info_dict"],
-                    scoped=self._scoped,
-                    backup_data=self._backup_data,
-                )
-                arch.insert(_info_dict=self._info_dict)
-                arch.save(
-                    dirname=self._path,
-                    name=self._module_name,
-                    package=True,
-                    data_format=self._data_format,
-                    force=True,
-                )
+    def _update(self, *args, **kw):
+        r"""Set the info for several names at once, like :meth:`dict.update`.
+
+        Each info assignment rewrites `__init__.py` with the complete
+        `_info_dict`, so this should be used when setting many entries: the
+        file is written once.
+        """
+        if self._mode == "r":
+            raise ValueError("DataSet opened in read-only mode.")
+
+        infos = dict(*args, **kw)
+        self._flush()
+        with self._ds_lock():
+            if self._synchronize:
+                self._load()
+
+            # The in-memory info no longer matches the file until it is saved.
+            self._info_dict_key = None
+            self._info_dict.update(infos)
+            self._save_info_dict()
 
     def __str__(self):
+        self._flush()
         if self._synchronize:
             self._load()
         return "DataSet %r containing %s" % (
@@ -3355,6 +3958,10 @@ class DataSet(object):
         When the data set is imported, the `info` will be restored as
         `info_dict[name].info` but the actual data `obj` will not be
         restored until `info_dict[name].load()` is called.
+
+        All objects are written under a single lock, and `__init__.py` is
+        written once at the end (also if an error occurs part way through, so
+        that the objects already written are listed).
         """
         names = set()
         if self._mode == "r":
@@ -3364,28 +3971,42 @@ class DataSet(object):
         else:
             info = None
 
-        # Why did I do this?  I don't use it...
-        # mod_dir = os.path.join(self._path, self._module_name)
-        for name in kw:
-            self[name] = info
-            self.__setattr__(name, kw[name])
-            names.add(name)
+        self._flush()
+        with self._ds_lock():
+            if self._synchronize:
+                self._load()
 
-        for obj in v:
-            i = self._maxint + 1
-            name = self._name_prefix + str(i)
-            while name in self._info_dict:
-                i += 1
+            items = list(kw.items())
+            for obj in v:
+                i = self._maxint + 1
                 name = self._name_prefix + str(i)
-            self._maxint = i
-            self[name] = info
-            self.__setattr__(name, obj)
-            names.add(name)
+                while name in self._info_dict or name in kw:
+                    i += 1
+                    name = self._name_prefix + str(i)
+                self._maxint = i
+                items.append((name, obj))
+
+            # The in-memory info no longer matches the file until it is saved.
+            self._info_dict_key = None
+            try:
+                for name, obj in items:
+                    self._save_attr(name, obj)
+                    self._info_dict[name] = info
+                    names.add(name)
+            finally:
+                if names:
+                    self._save_info_dict()
         return list(names)
 
     def _close(self):
-        self._unlock()
-        self._closed = True
+        try:
+            self._flush()
+        finally:
+            if self._writer is not None:
+                self._writer.shutdown(wait=False)
+                self._writer = None
+            self._unlock()
+            self._closed = True
 
     def __del__(self):
         r"""Make sure we unlock archive."""
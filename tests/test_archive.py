@@ -5,6 +5,7 @@ import math
 import os.path
 import shutil
 import sys
+import time
 import warnings
 
 import pytest
@@ -345,6 +346,7 @@ class TestSuite(ToolsMixin):
             == "dict(Q=1.0, a=_numpy.fromstring(" + "'`\\xbf=_Q-\\xf2?', dtype='<f8'))"
         )
 
+    @pytest.mark.version_specific
     @pytest.mark.skipif(
         sys.version_info < (3, 7), reason="Only python ^3.7 allows > 255 arguments"
     )
@@ -399,6 +401,18 @@ class TestNumpy(ToolsMixin):
         assert (a0 == a1).all()
         assert a0.shape == a1.shape
 
+    def test_numpy_tostring_layout(self, np):
+        """Non-contiguous and byte-swapped arrays are stored by value."""
+        x = np.arange(24.0).reshape(4, 6)
+        obj = dict(strided=x[::2, ::3], fortran=x.T, swapped=x.astype(">f8"))
+        arch = archive.Archive()
+        arch.insert(x=obj)
+        ld = {}
+        exec(str(arch), ld)
+        for key in obj:
+            assert np.array_equal(ld["x"][key], obj[key])
+            assert ld["x"][key].dtype == obj[key].dtype
+
     @pytest.mark.skip(reason="Known Failure")
     def test_numpy_types2(self, np):  # pragma: nocover
         """Test archiving of complex numpy types"""
@@ -504,6 +518,45 @@ class TestNumpy(ToolsMixin):
         assert np.allclose(d["M"], M)
         map(os.remove, files)
 
+    def test_max_workers(self, np, scoped):
+        """Computing the representations in threads should not change them."""
+        np.random.seed(1)
+        Ms = [np.random.rand(10, 10) for _n in range(8)]
+        obj = dict(Ms=Ms, M=Ms[0], x=[1.0, np.nan, np.inf])
+        res = []
+        for max_workers in [None, 4]:
+            a = archive.Archive(scoped=scoped, max_workers=max_workers)
+            a.insert(obj=obj, M=Ms[1], l=[Ms[2], Ms[3]])
+            res.append(str(a))
+        assert res[0] == res[1]
+
+        d = {}
+        exec(res[1], d)
+        assert all(np.allclose(_M0, _M1) for _M0, _M1 in zip(d["obj"]["Ms"], Ms))
+        assert d["obj"]["M"] is d["obj"]["Ms"][0]
+        assert d["M"] is d["obj"]["Ms"][1]
+
+    def test_max_workers_data(self, np, scoped):
+        """Arrays stored as data are named in the same order with threads."""
+
+        class SlowArchive(archive.Archive):
+            # Later arrays finish first when computed concurrently.
+            def _archive_ndarray(self, obj, env):
+                time.sleep(0.002 * (16 - obj.flat[0]))
+                return archive.Archive._archive_ndarray(self, obj, env)
+
+            _dispatch = dict(archive.Archive._dispatch)
+            _dispatch[np.ndarray] = _archive_ndarray
+
+        Ms = [np.full((10, 10), _n) for _n in range(16)]
+        res = []
+        for max_workers in [None, 4]:
+            a = SlowArchive(scoped=scoped, max_workers=max_workers, array_threshold=10)
+            a.insert(Ms=Ms, l=[Ms[2], [Ms[3]]])
+            res.append((str(a), {_k: id(_v) for _k, _v in a.data.items()}))
+        assert res[0] == res[1]
+        assert len(res[0][1]) == 16
+
 
 class TestScipy(ToolsMixin):
     """Run scipy specific tests"""
@@ -588,6 +641,33 @@ class TestDatafile(object):
         exec(s, ld)
         assert np.allclose(ld["M"], M)
 
+    def test_data_name(self, np):
+        """The name of the arrays dict can be set per archive."""
+        a = archive.Archive(array_threshold=2)
+        a.data_name = "_d"
+        M = np.random.rand(10)
+        a.insert(M=M)
+        s = str(a)
+        assert archive.Archive.data_name == "_arrays"
+        ld = {"_d": {list(a.data)[0]: M}}
+        exec(s, ld)
+        assert np.allclose(ld["M"], M)
+
+    def test_hdf5_layout(self, datadir, np, h5py):
+        """Only large arrays are chunked and compressed."""
+        arrays = dict(small=np.arange(10.0), large=np.zeros(10**5))
+        rep, files = archive.ArrayManager.save_arrays(
+            arrays, dirname=datadir, filename="data", data_format="hdf5"
+        )
+        with h5py.File(files[0], "r") as f:
+            assert f["small"].chunks is None
+            assert f["small"].compression is None
+            assert f["large"].chunks is not None
+            assert f["large"].compression == "lzf"
+        assert np.array_equal(
+            archive.ArrayManager.load_arrays(rep)["large"], arrays["large"]
+        )
+
 
 class TestImportableArchive(object):
     """Tests for the importable archive format provided in version 1.0"""
@@ -912,6 +992,19 @@ class TestRegression(object):
         assert y[0] is y[1]
         assert y_[0] is y_[1]
 
+    def test_builtin_types(self, scoped):
+        "Builtin types used to raise a KeyError."
+        import types
+
+        a = archive.Archive(scoped=scoped)
+        a.insert(x=int, y=types.FunctionType, z=type(None), l=[dict, dict])
+        d = {}
+        exec(str(a), d)
+        assert d["x"] is int
+        assert d["y"] is types.FunctionType
+        assert d["z"] is type(None)
+        assert d["l"] == [dict, dict]
+
 
 class TestPerformance(object):
     """Tests that could illustrate bad performance."""
@@ -933,6 +1026,32 @@ class TestPerformance(object):
         )
         archive._replace_rep(**args)
 
+    def test_insert_many(self):
+        r"""Inserting used to scan the whole archive (quadratic)."""
+        arch = archive.Archive()
+        xs = [[_n] for _n in range(10000)]
+        arch.insert(**{"x_{}".format(_n): x for _n, x in enumerate(xs)})
+        arch.insert(x_10=xs[10])  # Duplicates are okay
+        with pytest.raises(archive.DuplicateError):
+            arch.insert(x_10=xs[11])
+        assert len(arch.names()) == len(xs)
+
+    def test_deep_nesting(self):
+        r"""Building the graph used to recurse once per level."""
+        depth = 3 * sys.getrecursionlimit()
+        nested = []
+        for _n in range(depth):
+            nested = [nested, _n]
+        arch = archive.Archive(scoped=True)
+        arch.insert(nested=nested)
+        ld = {}
+        exec(str(arch), ld)
+        nested = ld["nested"]
+        for _n in reversed(range(depth)):
+            nested, n = nested
+            assert n == _n
+        assert nested == []
+
     def test_no_str_no_repr(self):
         r"""Test that str and repr are not called unnecessarily."""
         arch = archive.Archive()
@@ -1166,3 +1285,71 @@ def test_backup(datadir):
     assert os.path.exists(file3_bak)
     with open(file3_bak) as f:
         assert f.read() == "3"
+
+
+def test_replace_file(datadir):
+    file1 = os.path.join(datadir, "data1.txt")
+    with open(file1, "w") as _f:
+        _f.write("1")
+
+    # The original is untouched until the context completes.
+    with archive.replace_file(file1) as tmp_name:
+        with open(tmp_name, "w") as _f:
+            _f.write("2")
+        with open(file1) as _f:
+            assert _f.read() == "1"
+    with open(file1) as _f:
+        assert _f.read() == "2"
+    assert os.listdir(datadir) == ["data1.txt"]
+
+    # Errors leave the original and no temporary file.
+    with pytest.raises(NotImplementedError):
+        with archive.replace_file(file1, keep=True) as tmp_name:
+            with open(tmp_name, "w") as _f:
+                _f.write("3")
+            raise NotImplementedError("Failure")
+    with open(file1) as _f:
+        assert _f.read() == "2"
+    assert os.listdir(datadir) == ["data1.txt"]
+
+    # With keep=True the previous contents are backed up.
+    with archive.replace_file(file1, keep=True) as tmp_name:
+        with open(tmp_name, "w") as _f:
+            _f.write("3")
+    with open(file1 + ".bak") as _f:
+        assert _f.read() == "2"
+    with open(file1) as _f:
+        assert _f.read() == "3"
+
+
+def test_restore_cache():
+    """Repeated restores reuse the compiled code but not the namespace."""
+    arch = archive.Archive()
+    arch.insert(x=[1, 2])
+    s = str(arch)
+    d1 = archive.restore(s)
+    hits = archive._compile_archive.cache_info().hits
+    d2 = archive.restore(s, env=dict(y=3))
+    assert archive._compile_archive.cache_info().hits == hits + 1
+    assert d1["x"] == d2["x"] == [1, 2]
+    assert d1["x"] is not d2["x"]
+    assert d2["y"] == 3
+
+    # Large archives are not kept alive by the cache.
+    arch = archive.Archive()
+    arch.insert(x="x" * archive._COMPILE_CACHE_MAX_LEN)
+    misses = archive._compile_archive.cache_info().misses
+    assert len(archive.restore(str(arch))["x"]) == archive._COMPILE_CACHE_MAX_LEN
+    assert archive._compile_archive.cache_info().misses == misses
+
+
+def test_copy_archive():
+    """Archives can be pickled and copied."""
+    import copy
+    import pickle
+
+    arch = archive.Archive()
+    arch.insert(x=[1, 2])
+    for a in [pickle.loads(pickle.dumps(arch)), copy.deepcopy(arch)]:
+        assert archive.restore(str(a))["x"] == [1, 2]
+        assert a._lock is not arch._lock
@@ -13,6 +13,7 @@ if sys.version_info >= (3, 0):
     from importlib import reload
 
 
+@pytest.mark.slow
 def test_1():
     import tempfile, shutil, os
 
@@ -190,6 +191,200 @@ class TestDataSet(object):
         ds.x = 1
         del ds
 
+    def test_concurrent_writers(self, ds_name):
+        """The lock serializes writers so no update is lost."""
+        archive.DataSet(ds_name, "w")
+
+        def write(n):
+            ds = archive.DataSet(ds_name, "w", timeout=60)
+            ds["x_%i" % n] = n
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ds = archive.DataSet(ds_name, "r")
+        assert ds._info_dict == {"x_%i" % n: n for n in range(8)}
+
+    def test_shared_writers(self, ds_name):
+        """Threads can write through a shared instance."""
+        ds = archive.DataSet(ds_name, "w")
+
+        def write(n):
+            ds["x_%i" % n] = n
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert archive.DataSet(ds_name, "r")._info_dict == {
+            "x_%i" % n: n for n in range(8)
+        }
+
+    def test_lock_reentry(self, ds_name):
+        """Only the outermost _ds_lock takes and releases the lock file."""
+        ds = archive.DataSet(ds_name, "w")
+        lockfile = os.path.join(ds_name, ds._lock_file_name)
+        with ds._ds_lock():
+            ds["a"] = 1
+            assert os.path.exists(lockfile)
+        assert not os.path.exists(lockfile)
+        assert ds["a"] == 1
+
+    def test_insert_many(self, ds_name):
+        """_insert writes the info once for all objects."""
+        ds = archive.DataSet(ds_name, "w")
+        ds.x_0 = 0
+        calls = []
+        save_info_dict = ds._save_info_dict
+        ds._save_info_dict = lambda: calls.append(save_info_dict())
+        names = ds._insert(1, 2, y=3, info="info")
+        assert sorted(names) == ["x_1", "x_2", "y"]
+        assert len(calls) == 1
+        ds = archive.DataSet(ds_name, "r")
+        assert ds._info_dict == dict(x_0=None, x_1="info", x_2="info", y="info")
+        assert (ds.x_1, ds.x_2, ds.y) == (1, 2, 3)
+
+    def test_update(self, ds_name):
+        ds = archive.DataSet(ds_name, "w")
+        ds["a"] = 1
+        ds._update({"b": 2}, c=3)
+        assert archive.DataSet(ds_name, "r")._info_dict == dict(a=1, b=2, c=3)
+        with pytest.raises(ValueError):
+            archive.DataSet(ds_name, "r")._update(d=4)
+
+    def test_chdir(self, ds_name, datadir, monkeypatch):
+        """The data set does not depend on the working directory."""
+        ds = archive.DataSet(ds_name, "w")
+        ds.a = 1
+        monkeypatch.chdir(datadir)
+        ds.b = 2
+        ds["a"] = "info"
+        assert (ds.a, ds.b, ds["a"]) == (1, 2, "info")
+        ds.close()
+        assert not os.listdir(datadir)
+
+    def test_code_file(self, ds_name):
+        """Compiled code is shared between instances but never stale."""
+        ds = archive.DataSet(ds_name, "w")
+        ds.a = 1
+        assert ds.a == 1
+        assert os.listdir(os.path.join(ds_name, "__pycache__"))
+        ds1 = archive.DataSet(ds_name, "r")
+        ds1._code_cache.clear()
+        assert ds1.a == 1
+        ds.a = 2
+        assert ds1.a == 2
+        assert archive.DataSet(ds_name, "r").a == 2
+
+    def test_rewrite(self, ds_name):
+        """Rewrites must not be hidden by cached code."""
+        ds = archive.DataSet(ds_name, "w")
+        ds1 = archive.DataSet(ds_name, "r")
+        for n in range(10):
+            ds.a = n
+            ds["a"] = n
+            assert ds.a == n
+            assert ds1.a == n
+            assert ds1["a"] == n
+
+    def test_load_unchanged(self, ds_name):
+        """Synchronized reads do not reload an unchanged __init__.py."""
+        ds = archive.DataSet(ds_name, "w")
+        ds["a"] = 1
+        ds1 = archive.DataSet(ds_name, "r")
+        calls = []
+        _import = ds1._import
+        ds1._import = lambda *v: calls.append(v) or _import(*v)
+        assert ds1["a"] == 1
+        assert "a" in ds1
+        assert not calls
+        ds["b"] = 2
+        assert ds1["b"] == 2
+        assert len(calls) == 1
+
+    def test_unchanged_write(self, ds_name):
+        """Assigning an unchanged value does not rewrite the files."""
+        ds = archive.DataSet(ds_name, "w", backup_data=True)
+        ds.a = [1, 2]
+        ds["a"] = "info"
+        init_key = ds._info_key()
+        a_mtime = os.stat(os.path.join(ds_name, "a.py")).st_mtime_ns
+        backups = [_f for _f in os.listdir(ds_name) if _f.endswith(".bak")]
+        ds.a = ds.a
+        ds["a"] = ds["a"]
+        assert ds._info_key() == init_key
+        assert os.stat(os.path.join(ds_name, "a.py")).st_mtime_ns == a_mtime
+        assert [_f for _f in os.listdir(ds_name) if _f.endswith(".bak")] == backups
+
+    def test_inline_nbytes(self, ds_name, np, data_format):
+        """Small arrays can be kept in the module without a data file."""
+        a = np.arange(1000, dtype=float)
+        ds = archive.DataSet(
+            ds_name, "w", data_format=data_format, inline_nbytes=a.nbytes
+        )
+        ds.a = a
+        assert sorted(_f for _f in os.listdir(ds_name) if _f.startswith("a")) == [
+            "a.py"
+        ]
+        assert np.allclose(archive.DataSet(ds_name, "r").a, a)
+
+    def test_mmap_mode(self, ds_name, np):
+        """npy attributes can be memory mapped when loaded."""
+        a = np.arange(1000, dtype=float)
+        ds = archive.DataSet(ds_name, "w", mmap_mode="c")
+        ds.a = a
+        b = archive.DataSet(ds_name, "r").a
+        assert isinstance(b.base, np.memmap)
+        assert np.array_equal(a, b)
+        b[0] = -1  # Copy-on-write: the file is not changed
+        assert archive.DataSet(ds_name, "r").a[0] == 0
+
+    def test_background_writes(self, ds_name, np):
+        """Attributes can be written by a background thread."""
+        ds = archive.DataSet(ds_name, "w", background_writes=True)
+        a = np.arange(1000, dtype=float)
+        for n in range(10):
+            setattr(ds, "x%i" % n, n)
+        ds.a = a
+        assert np.allclose(ds.a, a)
+        assert ds.x9 == 9
+        ds["a"] = "info"
+        assert sorted(archive.DataSet(ds_name, "r")) == sorted(
+            ["a"] + ["x%i" % n for n in range(10)]
+        )
+
+        # A pending write is visible to new readers once waited for.
+        ds.y = [1, 2]
+        assert "y" in ds
+        assert archive.DataSet(ds_name, "r").y == [1, 2]
+
+        # Writes queued while this thread holds the lock are done inline.
+        results = []
+
+        def write():
+            with ds._ds_lock():
+                ds.z = 3
+                results.append((ds["z"], len(ds._write_queue)))
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+        assert results == [(None, 0)]
+        assert archive.DataSet(ds_name, "r").z == 3
+
+        class Unarchivable(object):
+            def get_persistent_rep(self, env):
+                raise ValueError("Unarchivable")
+
+        ds.b = Unarchivable()
+        with pytest.raises(ValueError, match="Unarchivable"):
+            ds.close()
+        assert not os.path.exists(os.path.join(ds_name, ds._lock_file_name))
+
 
 class TestCoverage(object):
     """